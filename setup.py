@@ -3,7 +3,7 @@ from setuptools import setup, find_packages
 setup(
     name='tesla',
     version='0.0.1',
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests', 'tests.*']),
     setup_requires=['wheel'],
     install_requires=[
         'certifi',
@@ -44,6 +44,9 @@ setup(
         'urllib3',
         'zipp',
     ],
+    extras_require={
+        'numba': ['numba'],
+    },
     entry_points={
         'console_scripts': [
             'Tesla = tesla.main:main',
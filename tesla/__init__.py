@@ -14,6 +14,9 @@ __all__ = [
     "calc_travel_time",
     "class_spectra",
     "curve_fitting",
+    "event_archive",
+    "joint_inversion",
+    "kernels",
     "load_object",
     "plot_spectra",
     "read_config",
@@ -10,18 +10,28 @@ EUPL © the European Union 2007, 2016
 Copyright (C) 2023 Guido Maria Adinolfi, University of Turin, Turin, Italy. For inquiries, contact: guidomaria.adinolfi@unito.it
 
 Dependencies:
+- functools
 - math
 - numpy
+- os
+- pandas
 - scipy
 - tesla.class_spectra.Spectra
+- tesla.kernels
+- tesla.source_spectrum_function
 - warnings 
 """
 
 # Import necessary modules
 import numpy as np
+import os
+import pandas as pd
+from functools import lru_cache
 from math import sqrt
 from tesla.class_spectra import Spectra
-from scipy.optimize import curve_fit, differential_evolution, OptimizeWarning, basinhopping
+from tesla.source_spectrum_function import SourceSpectraTheo
+from tesla.kernels import GetKernels, ModelSSE
+from scipy.optimize import curve_fit, differential_evolution, least_squares, OptimizeWarning, basinhopping
 import warnings 
 
 
@@ -32,61 +42,65 @@ warnings.filterwarnings("ignore", category=OptimizeWarning)
 
 
 
-#Define the theoretical function for the source spectra (from Abercrombie 1995)
-
-def SourceSpectraTheo(f1, DC1, fc1, Q):
+def calculateSSE(parameterTuple, f1, omg1, tt):
     """
-    Calculate theoretical source spectra.
+    Calculate the Sum of Squared Errors (SSE) between the observed spectrum and a theoretical model.
 
     Parameters:
-        f1 (numpy.ndarray): Array of frequencies.
-        DC1 (float): DC amplitude.
-        fc1 (float): Corner frequency.
-        Q (float): Q factor.
+    - parameterTuple: A tuple of parameters (omega, Fc, Q) for the theoretical spectrum model,
+                      or an array of shape (3, S) with a population of S parameter sets (as
+                      passed by differential_evolution with vectorized=True).
+    - f1: Array of frequencies of the observed spectrum.
+    - omg1: Array of amplitudes of the observed spectrum.
+    - tt: Travel time of the phase.
 
     Returns:
-        numpy.ndarray: Calculated source spectra.
+    - The SSE as a float, or an array of S SSE values for a population.
     """
-    gamma = 1
-    n = 2
-    n=np.array(n, dtype=float)
-    gamma=np.array(gamma, dtype=float)
-    f1=np.array(f1, dtype=float)
-    b = np.array(-1. * ((np.pi * f1 * tt) / Q), dtype=float)
-    return np.array((DC1 * np.e**(b))/(1. + (f1/fc1)**(gamma*n))**(1./gamma),dtype=float)
+    # Sum of squared differences between the observed and theoretical spectra (NumPy kernel)
+    return ModelSSE(parameterTuple, f1, omg1, tt)
 
 
 
-def calculateSSE(parameterTuple):
+def DifferentialEvolutionOptions(cfg):
     """
-    Calculate the Sum of Squared Errors (SSE) between the observed spectrum and a theoretical model.
+    Read the settings of the differential evolution search from the CurveFitting section.
 
     Parameters:
-    - parameterTuple: A tuple of parameters for the theoretical spectrum model.
+        cfg (dict): Configuration parameters from the TESLA package.
 
     Returns:
-    - The SSE as a float.
-
-    Note:
-    This function assumes the existence of a globally accessible observed spectrum `omg1`
-    and a function `SourceSpectraTheo(f1, *parameterTuple)` that computes the theoretical
-    spectrum given a frequency `f1` and model parameters.
+        dict: Keyword arguments for scipy.optimize.differential_evolution.
     """
-    # Calculate the theoretical spectrum for the given parameters
-    theo_spctr = SourceSpectraTheo(f1, *parameterTuple)
+    fitting = cfg["CurveFitting"]
+    options = {
+        'popsize': fitting.get("PopSize", 15),
+        'maxiter': fitting.get("MaxIter", 1000),
+        'tol': fitting.get("Tol", 0.01),
+    }
+
+    # The whole population is evaluated in one call, which requires the deferred updating
+    # (SciPy's default is the immediate updating, so this changes the search path: opt-in)
+    if fitting.get("Vectorized", False):
+        options['vectorized'] = True
+        options['updating'] = 'deferred'
 
-    # Compute and return the sum of squared differences between the observed and theoretical spectra
-    return np.sum((omg1 - theo_spctr) ** 2.0)
+    return options
 
 
 
-def find_optimal_params(ParameterBounds):
+def find_optimal_params(ParameterBounds, f1, omg1, tt, de_options=None, sse=None):
     """
     Find the optimal parameters using the differential evolution optimization algorithm.
     
     Parameters:
     - parameterBounds: A list of tuples defining the lower and upper bounds for each parameter
                        to be optimized. Each tuple corresponds to one parameter.
+    - f1: Array of frequencies of the observed spectrum.
+    - omg1: Array of amplitudes of the observed spectrum.
+    - tt: Travel time of the phase.
+    - de_options: Optional keyword arguments for differential_evolution (see DifferentialEvolutionOptions).
+    - sse: Optional SSE kernel with the signature of calculateSSE (default: calculateSSE).
 
     Returns:
     - An array of optimized parameter values.
@@ -100,38 +114,705 @@ def find_optimal_params(ParameterBounds):
     """
     
     # Execute differential evolution algorithm to find optimal parameters
-    optimized_params_result = differential_evolution(calculateSSE, ParameterBounds, seed=3)
+    optimized_params_result = differential_evolution(sse or calculateSSE, ParameterBounds, args=(f1, omg1, tt), seed=3, **(de_options or {}))
     
     # Return the optimized parameters
     return optimized_params_result.x
 
 
 
-def SpectraFitting(cfg, spectra, phase):
+#Fitting engines selectable with CurveFitting.Engine
+ENGINES = ['de+lm', 'trf', 'table+lm']
+
+#Engine that fits the spectra of many windows at once (see BatchSpectraFitting)
+BATCH_ENGINE = 'batch-lm'
+
+#Default number of Fc and t* nodes of the model lookup table
+TABLE_NODES = (64, 64)
+
+
+
+@lru_cache(maxsize=64)
+def _ModelTable(f_bytes, fcmin, fcmax, nfc):
     """
-    Perform curve fitting on seismic spectra.
+    Log-shapes of the source term of the theoretical spectrum over a grid of Fc.
+
+    The log-shape of the model (Omega0 = 1) at the node (Fc, t*) is the source term
+    -ln(1 + (f/Fc)^2) plus the attenuation term t* L, with L = -pi f. The attenuation term is
+    linear in t*, so the table holds only the Fc rows and does not depend on the travel time:
+    it is built once per frequency grid and shared by all the stations and phases. The squares
+    and products of the terms used by _TableMisfit are stored with the table.
+
+    Parameters:
+        f_bytes (bytes): Frequencies of the spectrum (float64 buffer).
+        fcmin, fcmax (float): Range of the Fc nodes (log-spaced).
+        nfc (int): Number of Fc nodes.
+
+    Returns:
+        fc (numpy.ndarray): Fc of each table row.
+        B (numpy.ndarray): Source term of each Fc node, shape (nfc, M).
+        L (numpy.ndarray): Attenuation term per unit t*, shape (M,).
+        B2, BL (numpy.ndarray): B^2 and B L, shape (nfc, M).
+        L2 (numpy.ndarray): L^2, shape (M,).
+    """
+    f1 = np.frombuffer(f_bytes, dtype=float)
+    fc = np.geomspace(fcmin, fcmax, nfc)
+    B = -np.log1p((f1 / fc[:, None]) ** 2)
+    L = -np.pi * f1
+
+    return fc, B, L, B ** 2, B * L, L ** 2
+
+
+def _TableMisfit(table, ts, omg, mask):
+    """
+    Misfit of the log-amplitudes of a stack of spectra at every (Fc, t*) node of the model table,
+    with the best ln Omega0 of each node.
+
+    The misfit of a node, sum w (y - shape - lnOmega0)^2 over the masked frequencies, is expanded in
+    the products of the spectra with B, B^2, B L, L and L^2 (see _ModelTable), so only the Fc rows of
+    the table are multiplied with the spectra and the t* nodes are combined afterwards.
+
+    Parameters:
+        table (tuple): The model table of the frequencies of the spectra (see _ModelTable).
+        ts (numpy.ndarray): t* nodes, shape (nts,).
+        omg (numpy.ndarray): Amplitudes of the spectra, shape (S, M).
+        mask (numpy.ndarray): Frequencies fitted for each spectrum, shape (S, M).
+
+    Returns:
+        misfit (numpy.ndarray): Misfit of each spectrum at each node, shape (S, nfc * nts), with the
+            nodes ordered by Fc and then by t*.
+        resid_sum (numpy.ndarray): Sum of the masked residuals y - shape of each node, shape (S, nfc * nts).
+        n (numpy.ndarray): Number of masked frequencies of each spectrum, shape (S, 1).
+    """
+    fc, B, L, B2, BL, L2 = table
+    w = mask.astype(float)
+    y = np.where(mask, np.log(np.where(mask, omg, 1.)), 0.)
+    n = w.sum(axis=1)[:, None]
+
+    wB, wB2, wBL, yB = w @ B.T, w @ B2.T, w @ BL.T, y @ B.T
+    wL, wL2, yL = (w @ L)[:, None, None], (w @ L2)[:, None, None], (y @ L)[:, None, None]
+
+    # Node sums of the shapes (w_L), of their squares (w_L2) and of their products with y (wy_L)
+    w_L = wB[:, :, None] + ts * wL
+    w_L2 = wB2[:, :, None] + 2. * ts * wBL[:, :, None] + ts ** 2 * wL2
+    wy_L = yB[:, :, None] + ts * yL
+    resid_sum = (y.sum(axis=1)[:, None, None] - w_L).reshape(len(w), -1)
+    misfit = (w_L2 - 2. * wy_L).reshape(len(w), -1) - resid_sum ** 2 / n
+
+    return misfit, resid_sum, n
+
+
+
+class SpectrumFitter:
+    """
+    Fit the theoretical source spectrum to an observed spectrum.
+
+    The fitter carries its own frequencies, amplitudes and travel time instead of
+    sharing them through module globals, so several fitters can run at the same time
+    (e.g. from a thread pool).
+
+    The available engines are:
+        - 'de+lm': global differential evolution search followed by a Levenberg-Marquardt
+          curve_fit on the amplitudes (default).
+        - 'trf': bounded Trust Region Reflective least_squares on the log-amplitudes, with
+          the analytic Jacobian of the model and no global search.
+        - 'table+lm': the starting point of the Levenberg-Marquardt curve_fit is the best node
+          of a precomputed table of model shapes instead of the differential evolution search.
+
+    The model, SSE and log-amplitude kernels come from the registry of tesla.kernels
+    (backend 'numpy', or 'numba' when it is installed).
+
+    If fixed_q is given (station-constrained attenuation), Q is not fitted: only omega and
+    Fc are inverted, with the model evaluated at fixed_q.
+    """
+    def __init__(self, f1, omg1, tt, de_options=None, table_nodes=TABLE_NODES, backend='numpy', fixed_q=None):
+        self.f1 = np.asarray(f1, dtype=float)
+        self.omg1 = np.asarray(omg1, dtype=float)
+        self.tt = tt
+        self.de_options = de_options
+        self.table_nodes = table_nodes
+        self.kernels = GetKernels(backend)
+        self.fixed_q = fixed_q
+
+    def model(self, f1, DC1, fc1, Q):
+        """
+        Theoretical source spectrum for the travel time of the fitter.
+        """
+        return self.kernels['model'](f1, DC1, fc1, Q, self.tt)
+
+    def sse(self, parameterTuple):
+        """
+        Sum of Squared Errors between the observed spectrum and the model.
+        """
+        return self.kernels['sse'](parameterTuple, self.f1, self.omg1, self.tt)
+
+    def log_residuals(self, x):
+        """
+        Log-amplitude residuals of the model for x = (ln omega, Fc, Q).
+        """
+        return self.kernels['log_residuals'](x, self.f1, self.omg1, self.tt)
+
+    def log_jacobian(self, x):
+        """
+        Analytic Jacobian of the log-amplitude residuals with respect to (ln omega, Fc, Q).
+        """
+        return self.kernels['log_jacobian'](x, self.f1, self.tt)
+
+    def fixed_sse(self, parameterTuple, f1, omg1, tt):
+        """
+        Sum of Squared Errors for (omega, Fc), or a (2, S) population, with Q fixed to fixed_q.
+        """
+        p = np.asarray(parameterTuple, dtype=float)
+        return self.kernels['sse'](np.concatenate([p, np.full((1,) + p.shape[1:], self.fixed_q)]), f1, omg1, tt)
+
+    def lm(self, p0):
+        """
+        Levenberg-Marquardt curve_fit of the amplitudes starting from p0 (omega, Fc and Q).
+        If fixed_q is set, only omega and Fc are fitted and the error of Q is 0.
+
+        Returns:
+            popt (numpy.ndarray): Fitted omega, Fc and Q.
+            perr (numpy.ndarray): Errors of the fitted parameters.
+        """
+        if self.fixed_q is None:
+            popt, pcov = curve_fit(self.model, self.f1, self.omg1, method='lm', maxfev=300000, p0=p0)
+            return popt, np.sqrt(np.diag(pcov))
+
+        popt, pcov = curve_fit(lambda f1, DC1, fc1: self.model(f1, DC1, fc1, self.fixed_q), self.f1, self.omg1,
+                               method='lm', maxfev=300000, p0=p0[:2])
+        return np.append(popt, self.fixed_q), np.append(np.sqrt(np.diag(pcov)), 0.)
+
+    def table_start(self, ParameterBounds):
+        """
+        Starting omega, Fc and Q from the model lookup table.
+
+        The nodes are a grid of Fc and t* = tt/Q within the bounds (a single t* if fixed_q is set);
+        the table of the Fc rows is built once per frequency grid (see _ModelTable). For each node
+        the best omega in log space is the mean log residual, so the misfit of all the nodes is
+        obtained from a few matrix products (see _TableMisfit) and the node with the lowest misfit
+        is returned.
+
+        Parameters:
+            ParameterBounds (list): Bounds of omega, Fc and Q.
+
+        Returns:
+            tuple: Starting omega, Fc and Q.
+        """
+        (DCmin, DCmax), (fcmin, fcmax), (Qmin, Qmax) = ParameterBounds
+        nfc, nts = self.table_nodes
+        if self.fixed_q is not None:
+            Qmin, Qmax, nts = self.fixed_q, self.fixed_q, 1
+        table = _ModelTable(self.f1.tobytes(), float(fcmin), float(fcmax), int(nfc))
+        fc, B, L = table[:3]
+        ts = np.geomspace(self.tt / Qmax, self.tt / Qmin, int(nts))
+
+        misfit, resid_sum, n = _TableMisfit(table, ts, self.omg1[None, :], np.ones((1, len(self.f1)), dtype=bool))
+        kfc, kts = divmod(int(np.argmin(misfit[0])), len(ts))
+
+        DC1 = np.clip(np.exp(np.log(self.omg1).mean() - (B[kfc] + ts[kts] * L).mean()), DCmin, DCmax)
+
+        return DC1, fc[kfc], self.tt / ts[kts]
+
+    def fit_trf(self, ParameterBounds, p0=None):
+        """
+        Fit the log-amplitudes with the bounded Trust Region Reflective algorithm.
+
+        The search starts from the low-frequency level of the observed spectrum and from a few
+        corner frequencies spread over the Fc bounds; the solution with the lowest cost is kept.
+        If fixed_q is set, only omega and Fc are fitted.
+
+        Parameters:
+            ParameterBounds (list): Bounds of omega, Fc and Q.
+            p0 (tuple, optional): Single starting omega, Fc and Q, used instead of the default starts.
+
+        Returns:
+            popt (numpy.ndarray): Fitted omega, Fc and Q.
+            perr (numpy.ndarray): Errors of the fitted parameters.
+        """
+        (DCmin, DCmax), (fcmin, fcmax), (Qmin, Qmax) = ParameterBounds
+        lower = np.array([np.log(DCmin), fcmin, Qmin], dtype=float)
+        upper = np.array([np.log(DCmax), fcmax, Qmax], dtype=float)
+
+        if p0 is not None:
+            starts = [np.array([np.log(p0[0]), p0[1], p0[2]], dtype=float)]
+        else:
+            starts = [np.array([np.log(np.mean(self.omg1[:3])), fc0, np.sqrt(Qmin * Qmax)])
+                      for fc0 in np.geomspace(fcmin, fcmax, 5)[1:-1]]
+
+        # With a fixed Q, the residuals and the Jacobian are those of (ln omega, Fc) only
+        if self.fixed_q is None:
+            n, residuals, jacobian = 3, self.log_residuals, self.log_jacobian
+        else:
+            n = 2
+            residuals = lambda x: self.log_residuals(np.append(x, self.fixed_q))
+            jacobian = lambda x: self.log_jacobian(np.append(x, self.fixed_q))[:, :2]
+            lower, upper = lower[:2], upper[:2]
+
+        best = None
+        for x0 in starts:
+            x0 = np.clip(x0[:n], lower + 1e-9 * (upper - lower), upper - 1e-9 * (upper - lower))
+            res = least_squares(residuals, x0, jac=jacobian, bounds=(lower, upper), method='trf')
+            if best is None or res.cost < best.cost:
+                best = res
+
+        # Parameter errors from the Jacobian at the solution (as curve_fit does)
+        dof = max(self.f1.size - n, 1)
+        pcov = np.linalg.pinv(best.jac.T @ best.jac) * (2. * best.cost / dof)
+        perr = np.sqrt(np.abs(np.diag(pcov)))
+
+        DC1 = np.exp(best.x[0])
+        if self.fixed_q is None:
+            popt = np.array([DC1, best.x[1], best.x[2]])
+            perr = np.array([DC1 * perr[0], perr[1], perr[2]])
+        else:
+            popt = np.array([DC1, best.x[1], self.fixed_q])
+            perr = np.array([DC1 * perr[0], perr[1], 0.])
+
+        return popt, perr
+
+    def fit_local(self, ParameterBounds, engine, p0):
+        """
+        Run only the local fit of the selected engine, starting from p0.
+
+        Parameters:
+            ParameterBounds (list): Bounds of omega, Fc and Q.
+            engine (str): Fitting engine, one of ENGINES.
+            p0 (tuple): Starting omega, Fc and Q.
+
+        Returns:
+            popt (numpy.ndarray): Fitted omega, Fc and Q.
+            perr (numpy.ndarray): Errors of the fitted parameters.
+        """
+        if engine == 'trf':
+            return self.fit_trf(ParameterBounds, p0)
+
+        return self.lm(p0)
+
+    def accept(self, popt, perr, ParameterBounds, rms_thr=None):
+        """
+        Check a fit: parameters within the bounds (omega and Fc only, if Q is fixed), finite
+        errors and, if rms_thr is given, normalized RMS (mean absolute percentage error) not
+        above rms_thr.
+        """
+        lower, upper = np.array(ParameterBounds, dtype=float).T
+        n = 3 if self.fixed_q is None else 2
+        if not (np.all(np.isfinite(popt)) and np.all(np.isfinite(perr))):
+            return False
+        if np.any(popt[:n] < lower[:n]) or np.any(popt[:n] > upper[:n]):
+            return False
+        if rms_thr is not None:
+            rms_norm = np.mean(np.abs((self.omg1 - self.model(self.f1, *popt)) / self.omg1)) * 100
+            if rms_norm > rms_thr:
+                return False
+        return True
+
+    def fit(self, ParameterBounds, engine='de+lm', p0=None, rms_thr=None):
+        """
+        Fit the observed spectrum with the selected engine.
+
+        With the default 'de+lm' engine, run the global differential evolution search followed
+        by the Levenberg-Marquardt fit. With 'table+lm', the Levenberg-Marquardt fit starts from
+        the best node of the model lookup table and the global search is run only if this fit
+        fails or its parameters are out of the bounds.
+
+        If p0 is given (warm start), the local fit starts from p0 and the global search is run
+        only if the warm-started fit fails or does not pass the accept check.
+
+        If fixed_q is set, every engine fits only omega and Fc (the search of differential
+        evolution is two-dimensional) and returns the fixed Q with a zero error.
+
+        Parameters:
+            ParameterBounds (list): Bounds of omega, Fc and Q for the global search.
+            engine (str): Fitting engine, one of ENGINES.
+            p0 (tuple, optional): Starting omega, Fc and Q (e.g. the fit of a neighbouring window).
+            rms_thr (float, optional): Maximum normalized RMS of an accepted warm-started fit.
+
+        Returns:
+            popt (numpy.ndarray): Fitted omega, Fc and Q.
+            perr (numpy.ndarray): Errors of the fitted parameters.
+        """
+        if engine not in ENGINES:
+            raise ValueError("CurveFitting Engine must be one of %s" % (ENGINES))
+
+        if p0 is not None:
+            try:
+                popt, perr = self.fit_local(ParameterBounds, engine, p0)
+                if self.accept(popt, perr, ParameterBounds, rms_thr):
+                    return popt, perr
+            except (RuntimeError, ValueError, np.linalg.LinAlgError):
+                pass
+
+        if engine == 'trf':
+            return self.fit_trf(ParameterBounds)
+
+        if engine == 'table+lm':
+            # the differential evolution search is run only if the table-started fit fails
+            try:
+                popt, perr = self.fit_local(ParameterBounds, engine, self.table_start(ParameterBounds))
+                if self.accept(popt, perr, ParameterBounds):
+                    return popt, perr
+            except (RuntimeError, ValueError, np.linalg.LinAlgError):
+                pass
+
+        # by default, differential_evolution completes by calling curve_fit() using parameter bounds
+        if self.fixed_q is None:
+            OptimalParameters = find_optimal_params(ParameterBounds, self.f1, self.omg1, self.tt, self.de_options, self.kernels['sse'])
+        else:
+            OptimalParameters = np.append(find_optimal_params(ParameterBounds[:2], self.f1, self.omg1, self.tt, self.de_options, self.fixed_sse), self.fixed_q)
+
+        #Last version LM, with the Parameter Errors
+        return self.lm(OptimalParameters)
+
+
+
+def SkipFitting(spectra):
+    """
+    Record a spectrum that is not fitted (e.g. rejected by the SNR pre-filter).
+
+    The CurveFit fields are set to NaN, so the spectrum keeps its SNR percentage but is
+    discarded by SpectraSelection as any spectrum with non-finite parameters.
 
     Parameters:
-        cfg (dict): Configuration parameters from the TESLA package.
         spectra (Spectra): Spectra object containing spectral data.
+
+    Returns:
+        Spectra: Spectra object with an empty (NaN) CurveFit.
+    """
+    spectra.CurveFit = dict.fromkeys(['Omega0', 'Omega0Err', 'Fc', 'FcErr', 'Q', 'QErr', 'Rms1', 'Rms2', 'DeltaOmega', 'FixedQ'], np.nan)
+    spectra.CalculatedSpectrum = []
+
+    return spectra
+
+
+
+def LogResample(f1, omg1, npts):
+    """
+    Resample a spectrum on (at most) npts log-spaced frequencies.
+
+    The band between the first and last frequency is split into npts bins of equal width in
+    log-frequency; each non-empty bin is replaced by the geometric mean of its frequencies and
+    of its amplitudes. At low frequencies, where the bins are narrower than the frequency
+    step, the original points are kept; at high frequencies the many linear bins are averaged.
+
+    Parameters:
+        f1 (numpy.ndarray): Frequencies of the spectrum.
+        omg1 (numpy.ndarray): Amplitudes of the spectrum.
+        npts (int): Number of log-spaced bins. The spectrum is returned unchanged if npts
+            is 0 or not smaller than the number of frequencies.
+
+    Returns:
+        tuple: Resampled frequencies and amplitudes.
+    """
+    if not npts or npts >= len(f1) or len(f1) < 2:
+        return f1, omg1
+
+    logf = np.log(f1)
+    edges = np.linspace(logf[0], logf[-1], int(npts) + 1)
+    bins = np.clip(np.searchsorted(edges, logf, side='right') - 1, 0, int(npts) - 1)
+    count = np.bincount(bins, minlength=int(npts))
+    keep = count > 0
+
+    f_log = np.exp(np.bincount(bins, weights=logf, minlength=int(npts))[keep] / count[keep])
+    omg_log = np.exp(np.bincount(bins, weights=np.log(omg1), minlength=int(npts))[keep] / count[keep])
+
+    return f_log, omg_log
+
+
+def BatchTableStart(f, omg, mask, tt, ParameterBounds, table_nodes=TABLE_NODES):
+    """
+    Starting omega, Fc and Q of a stack of spectra from the model lookup table.
+
+    Same search as SpectrumFitter.table_start, for S spectra sharing the travel time tt, each
+    one fitted only where its mask is True. The misfit of all the table nodes for all the spectra
+    sharing a frequency grid is obtained from a few matrix products (see _TableMisfit).
+
+    Parameters:
+        f (numpy.ndarray): Frequencies shared by the spectra, shape (M,), or frequencies of
+            each spectrum, shape (S, M).
+        omg (numpy.ndarray): Amplitudes of the spectra, shape (S, M).
+        mask (numpy.ndarray): Frequencies fitted for each spectrum, shape (S, M).
+        tt (float): Travel time of the phase.
+        ParameterBounds (list): Bounds of omega, Fc and Q.
+        table_nodes (tuple, optional): Number of Fc and t* nodes of the table.
+
+    Returns:
+        numpy.ndarray: Starting omega, Fc and Q of each spectrum, shape (S, 3).
+    """
+    if np.ndim(f) == 2:
+        grids, inverse = np.unique(f, axis=0, return_inverse=True)
+        p0 = np.empty((len(omg), 3))
+        for g, grid in enumerate(grids):
+            rows = inverse.ravel() == g
+            p0[rows] = BatchTableStart(grid, omg[rows], mask[rows], tt, ParameterBounds, table_nodes)
+        return p0
+
+    (DCmin, DCmax), (fcmin, fcmax), (Qmin, Qmax) = ParameterBounds
+    nfc, nts = table_nodes
+    table = _ModelTable(np.ascontiguousarray(f, dtype=float).tobytes(), float(fcmin), float(fcmax), int(nfc))
+    fc = table[0]
+    ts = np.geomspace(tt / Qmax, tt / Qmin, int(nts))
+
+    misfit, resid_sum, n = _TableMisfit(table, ts, omg, mask)
+
+    k = np.argmin(misfit, axis=1)
+    rows = np.arange(len(k))
+
+    DC1 = np.clip(np.exp(resid_sum[rows, k] / n[:, 0]), DCmin, DCmax)
+
+    return np.column_stack([DC1, fc[k // len(ts)], tt / ts[k % len(ts)]])
+
+
+def BatchLevenbergMarquardt(f, omg, mask, tt, p0, maxiter=500, ftol=1.49012e-08, xtol=1.49012e-08, fixed_q=None):
+    """
+    Levenberg-Marquardt fit of the theoretical source spectrum to a stack of spectra.
+
+    The damped Gauss-Newton iterations of all the spectra run together on (S, M) arrays,
+    with the analytic Jacobian of the model, the diagonal (Marquardt) scaling of the damping
+    and a damping factor per spectrum. As curve_fit, the sum of squared amplitude residuals
+    is minimized and the errors are the square roots of the diagonal of the covariance
+    inv(J^T J) * SSE / (npts - 3). Each spectrum stops iterating when it has converged.
+
+    Parameters:
+        f (numpy.ndarray): Frequencies shared by the spectra, shape (M,), or frequencies of
+            each spectrum, shape (S, M).
+        omg (numpy.ndarray): Amplitudes of the spectra, shape (S, M).
+        mask (numpy.ndarray): Frequencies fitted for each spectrum, shape (S, M).
+        tt (float): Travel time of the phase.
+        p0 (numpy.ndarray): Starting omega, Fc and Q of each spectrum, shape (S, 3).
+        maxiter (int, optional): Maximum number of iterations.
+        ftol, xtol (float, optional): Relative tolerances on the SSE and on the parameters
+            (as in curve_fit).
+        fixed_q (float, optional): If given, Q is fixed to this value (the Q column of p0) and
+            only omega and Fc are fitted; the error of Q is 0.
+
+    Returns:
+        popt (numpy.ndarray): Fitted omega, Fc and Q, shape (S, 3).
+        perr (numpy.ndarray): Errors of the fitted parameters, shape (S, 3).
+        converged (numpy.ndarray): True for the spectra whose fit has converged, shape (S,).
+    """
+    w = mask.astype(float)
+    obs = np.where(mask, omg, 0.)
+    free = np.array([1., 1., 0. if fixed_q is not None else 1.])
+
+    def freqs(rows):
+        return f if np.ndim(f) == 1 else f[rows]
+
+    def residuals(P, rows):
+        DC1, fc1, Q = P[:, 0:1], P[:, 1:2], P[:, 2:3]
+        f = freqs(rows)
+        q = (f / fc1) ** 2
+        m = DC1 * np.exp(-np.pi * f * tt / Q) / (1. + q)
+        r = w[rows] * (m - obs[rows])
+        return r, np.einsum('sm,sm->s', r, r)
+
+    def normal_equations(P, rows, r):
+        # Jacobian as (S, 3, M), with the columns scaled to unit norm (scale, shape (S, 3))
+        DC1, fc1, Q = P[:, 0:1], P[:, 1:2], P[:, 2:3]
+        f = freqs(rows)
+        q = (f / fc1) ** 2
+        m = w[rows] * DC1 * np.exp(-np.pi * f * tt / Q) / (1. + q)
+        J = np.stack([m / DC1, m * 2. * q / (fc1 * (1. + q)), m * np.pi * f * tt / Q ** 2], axis=1) * free[:, None]
+        scale = np.where(free > 0, np.sqrt(np.einsum('sim,sim->si', J, J)) + np.finfo(float).tiny, 1.)
+        J /= scale[..., None]
+        return J @ J.transpose(0, 2, 1), np.einsum('sim,sm->si', J, r), scale
+
+    P = np.array(p0, dtype=float)
+    rows = np.arange(len(P))
+    r, sse = residuals(P, rows)
+    A, g, scale = normal_equations(P, rows, r)
+    lam = np.full(len(P), 1e-3)
+    converged = np.zeros(len(P), dtype=bool)
+    eye = np.eye(3)
+    active = np.flatnonzero(np.isfinite(sse))
+
+    for it in range(maxiter):
+        if not len(active):
+            break
+
+        # Damped Gauss-Newton step in the scaled parameters (unit diagonal of J^T J)
+        M = A[active] + lam[active, None, None] * eye
+        try:
+            step = -np.linalg.solve(M, g[active][..., None])[..., 0] / scale[active]
+        except np.linalg.LinAlgError:
+            step = -(np.linalg.pinv(M) @ g[active][..., None])[..., 0] / scale[active]
+
+        P_try = P[active] + step
+        r_try, sse_try = residuals(P_try, active)
+
+        better = np.isfinite(sse_try) & (sse_try <= sse[active])
+        done = better & ((sse[active] - sse_try <= ftol * sse[active])
+                         | np.all(np.abs(step) <= xtol * (np.abs(P[active]) + xtol), axis=1))
+
+        # Accepted steps: move and relax the damping; rejected steps: increase the damping
+        lam[active] = np.where(better, np.maximum(lam[active] / 10., 1e-12), lam[active] * 10.)
+        moved = active[better]
+        if len(moved):
+            P[moved] = P_try[better]
+            sse[moved] = sse_try[better]
+            A[moved], g[moved], scale[moved] = normal_equations(P[moved], moved, r_try[better])
+
+        converged[active[done]] = True
+        active = active[~done & (lam[active] < 1e16)]
+
+    # Rejected steps at very large damping: no further decrease of the SSE is possible
+    converged |= np.isfinite(sse) & (lam >= 1e16)
+
+    dof = np.maximum(w.sum(axis=1) - free.sum(), 1)
+    pcov = np.linalg.pinv(A) / (scale[:, :, None] * scale[:, None, :]) * (sse / dof)[:, None, None]
+    perr = np.sqrt(np.abs(np.diagonal(pcov, axis1=1, axis2=2))) * free
+
+    return P, perr, converged
+
+
+def BatchSpectraFitting(cfg, SpectraList, phase):
+    """
+    Perform curve fitting on many seismic spectra at once (CurveFitting.Engine 'batch-lm').
+
+    The spectra are grouped by frequency grid (up to Fmax), travel time and fixed Q (see StationQ);
+    with CurveFitting.LogResample the resampled grids depend on the window duration, so the spectra
+    are grouped by number of resampled frequencies instead, each one with its own grid. For each group,
+    the starting points come from the model lookup table (BatchTableStart) and all the spectra
+    are fitted together by BatchLevenbergMarquardt, each one only between its own 1/wind_dur
+    and Fmax. The spectra whose batched fit does not converge, or gives non-finite errors or
+    parameters out of the bounds, are fitted one at a time with the 'table+lm' engine.
+
+    Parameters:
+        cfg (dict): Configuration parameters from the TESLA package.
+        SpectraList (list): Spectra objects containing spectral data.
         phase (str): Seismic phase ('P' or 'S').
 
     Returns:
-        Spectra: Spectra object with fitted parameters and updated data.
+        list: Spectra objects with fitted parameters and updated data, in the same order.
     """
-    # Get configuration parameters
     ParameterBounds=[tuple(cfg["CurveFitting"]["OmegaBounds"]), tuple(cfg["CurveFitting"]["FcBounds"]), tuple(cfg["CurveFitting"]["QBounds"])]
+    Fmax = float(cfg["SourceSpectra"]["Fmax"])
+    table_nodes = cfg["CurveFitting"].get("TableNodes", TABLE_NODES)
+    de_options = DifferentialEvolutionOptions(cfg)
+    log_resample = cfg["CurveFitting"].get("LogResample", 0)
+    backend = cfg["CurveFitting"].get("Backend", "numpy")
+
+    bands = [FittingBand(cfg, spectra, phase) for spectra in SpectraList]
+    fits = [None] * len(SpectraList)
+
+    # Group the spectra by frequency grid (or resampled grid length) and travel time; each spectrum is fitted where its mask is True
+    groups = {}
+    for k, (spectra, (f1, omg1, f1_noise, omg1_noise, tt)) in enumerate(zip(SpectraList, bands)):
+        if len(f1) < 4:
+            continue
+        if log_resample:
+            grid, amp, mask = f1, omg1, np.ones(len(f1), dtype=bool)
+        else:
+            Fred = np.asarray(spectra.SigFrequencies)
+            keep = Fred <= Fmax
+            grid, amp = Fred[keep], np.abs(spectra.SigSpectrum)[keep]
+            mask = grid >= f1[0]
+        fixed_q = StationQ(cfg, spectra.station, phase, tt)
+        group = groups.setdefault((len(grid) if log_resample else grid.tobytes(), tt, fixed_q), ([], [], [], []))
+        group[0].append(grid)
+        group[1].append(k)
+        group[2].append(amp)
+        group[3].append(mask)
+
+    for (key, tt, fixed_q), (grid, index, amp, mask) in groups.items():
+        grid, amp, mask = np.vstack(grid) if log_resample else grid[0], np.vstack(amp), np.vstack(mask)
+        if fixed_q is None:
+            p0 = BatchTableStart(grid, amp, mask, tt, ParameterBounds, table_nodes)
+        else:
+            p0 = BatchTableStart(grid, amp, mask, tt, ParameterBounds[:2] + [(fixed_q, fixed_q)], (table_nodes[0], 1))
+        popt, perr, converged = BatchLevenbergMarquardt(grid, amp, mask, tt, p0, fixed_q=fixed_q)
+        for row, k in enumerate(index):
+            if converged[row]:
+                fits[k] = (popt[row], perr[row])
+
+    for k, (spectra, (f1, omg1, f1_noise, omg1_noise, tt)) in enumerate(zip(SpectraList, bands)):
+        fixed_q = StationQ(cfg, spectra.station, phase, tt)
+        fitter = SpectrumFitter(f1, omg1, tt, de_options, table_nodes, backend, fixed_q)
+        if fits[k] is not None and fitter.accept(fits[k][0], fits[k][1], ParameterBounds):
+            popt1, pcov1 = fits[k]
+        else:
+            popt1, pcov1 = fitter.fit(ParameterBounds, 'table+lm')
+        SpectraList[k] = StoreFit(spectra, f1, omg1, f1_noise, omg1_noise, popt1, pcov1, fitter.model(f1, *popt1), fixed_q)
+
+    return SpectraList
+
+
+@lru_cache(maxsize=None)
+def PriorRunQ(runs, sta, phase):
+    """
+    Q of a station from prior TESLA runs: the median Q of the selected spectra of the station
+    (phase/station/sel_spectra/Source_Spectra.best.<station>.csv) in the given event directories.
+
+    Parameters:
+        runs (tuple): Event directories of the prior runs.
+        sta (str): The name of the seismic station.
+        phase (str): Seismic phase ('P' or 'S').
+
+    Returns:
+        float: The median Q, or None if no prior run has selected spectra for the station.
+    """
+    Q = []
+    for run in runs:
+        filename = os.path.join(run, phase, sta, 'sel_spectra', 'Source_Spectra.best.%s.csv' % (sta))
+        if os.path.isfile(filename):
+            Q.extend(pd.read_csv(filename)['Q'].dropna().tolist())
+
+    return float(np.median(Q)) if Q else None
+
+
+def StationQ(cfg, sta, phase, tt):
+    """
+    Fixed Q of a station for the station-constrained attenuation mode, or None if Q is fitted.
+
+    The value is taken from CurveFitting.FixedQ (Q per station), else from CurveFitting.FixedTStar
+    (t* per station, Q = tt / t*), else from the prior runs of CurveFitting.FixedQRun (see PriorRunQ).
+    A station value can be a number or a mapping with a value per phase ('P' and 'S').
+
+    Parameters:
+        cfg (dict): Configuration parameters from the TESLA package.
+        sta (str): The name of the seismic station.
+        phase (str): Seismic phase ('P' or 'S').
+        tt (float): Travel time of the phase.
+
+    Returns:
+        float: The fixed Q, or None.
+    """
+    fitting = cfg["CurveFitting"]
+
+    def station_value(table):
+        value = (table or {}).get(sta)
+        return value.get(phase) if isinstance(value, dict) else value
+
+    Q = station_value(fitting.get("FixedQ"))
+    if Q is None:
+        tstar = station_value(fitting.get("FixedTStar"))
+        Q = tt / tstar if tstar else None
+    if Q is None and fitting.get("FixedQRun"):
+        runs = fitting["FixedQRun"]
+        Q = PriorRunQ(tuple([runs] if isinstance(runs, str) else runs), sta, phase)
+
+    return None if Q is None else float(Q)
+
+
+def FittingBand(cfg, spectra, phase):
+    """
+    Cut the signal and noise spectra to the fitting band, from 1/wind_dur to Fmax.
+
+    Parameters:
+        cfg (dict): Configuration parameters from the TESLA package.
+        spectra (Spectra): Spectra object containing spectral data.
+        phase (str): Seismic phase ('P' or 'S').
+
+    Returns:
+        tuple: Signal frequencies and amplitudes (resampled if CurveFitting.LogResample is set),
+            noise frequencies and amplitudes, and travel time of the phase.
+    """
     wind_dur = float(spectra.SigWindTimes[1] - spectra.SigWindTimes[0])
     Fmax = float(cfg["SourceSpectra"]["Fmax"])
     Fmin = 1 / wind_dur
-    Fred = spectra.SigFrequencies
-    Fred_noise = spectra.NoiseFrequencies
-    PHTred = spectra.SigSpectrum
-    PHTred_noise = spectra.NoiseSpectrum
-
-    global tt
-    global f1
-    global omg1
+    Fred = np.asarray(spectra.SigFrequencies)
+    Fred_noise = np.asarray(spectra.NoiseFrequencies)
+    PHTred = np.abs(spectra.SigSpectrum)
+    PHTred_noise = np.abs(spectra.NoiseSpectrum)
 
     if phase == 'P':
         tt = spectra.Ptraveltime
@@ -139,52 +820,40 @@ def SpectraFitting(cfg, spectra, phase):
         tt = spectra.Straveltime
 
     # Filter frequencies within range
-    dat = np.column_stack((Fred, np.abs(PHTred)))
-    f1 = []
-    omg1 = []
-    for k in np.arange(0, len(dat[:, 0]), 1):
-        if Fmin <= dat[k, 0] <= Fmax:
-            f1.append(dat[k, 0])
-            omg1.append(dat[k, 1])
-
-    # Filter noise frequencies within range
-    dat_noise = np.column_stack((Fred_noise, np.abs(PHTred_noise)))
-    f1_noise = []
-    omg1_noise = []
-    for kk in np.arange(0, len(dat_noise[:, 0]), 1):
-        if Fmin <= dat_noise[kk, 0] <= Fmax:
-            f1_noise.append(dat_noise[kk, 0])
-            omg1_noise.append(dat_noise[kk, 1])
+    band = (Fred >= Fmin) & (Fred <= Fmax)
+    f1 = Fred[band]
+    omg1 = PHTred[band]
 
+    # Resample the observed spectrum on log-spaced frequencies
+    f1, omg1 = LogResample(f1, omg1, cfg["CurveFitting"].get("LogResample", 0))
 
-    # by default, differential_evolution completes by calling curve_fit() using parameter bounds
-    OptimalParameters = find_optimal_params(ParameterBounds)
+    # Filter noise frequencies within range
+    band_noise = (Fred_noise >= Fmin) & (Fred_noise <= Fmax)
+    f1_noise = Fred_noise[band_noise]
+    omg1_noise = PHTred_noise[band_noise]
 
-    # Curve Fitting
-    #popt1, pcov1 = curve_fit(SourceSpectraTheo, f1, omg1, method='trf', bounds=([min(spectra.SigSpectrum), 5, 1], [max(spectra.SigSpectrum), 80, 900]) )
-    #popt1,pcov1 = curve_fit(SourceSpectraTheo, f1, omg1,  method='lm', maxfev=300000)
-    #popt1,pcov1 = curve_fit(SourceSpectraTheo, f1, omg1,  method='lm', maxfev=300000, p0=(initDC,initFc,initQ,initN))
-    #popt1,pcov1 = curve_fit(SourceSpectraTheo, f1, omg1,  method='lm', maxfev=300000, p0=(initDC,initFc,initQ))
-    #Basin Hopping
-    #minimizer_kwargs = {"method": "L-BFGS-B", "bounds": ParameterBounds}
-    #res = basinhopping(calculateSSE, x0=OptimalParameters, niter=200, minimizer_kwargs=minimizer_kwargs)
-    #popt1=res.x
+    return f1, omg1, f1_noise, omg1_noise, tt
 
-    #Last version LM
-    popt1,pcov1 = curve_fit(SourceSpectraTheo, f1, omg1,  method='lm', maxfev=300000, p0=OptimalParameters)
 
-    # Parameter Errors Last version
-    pcov1 = np.sqrt(np.diag(pcov1))
+def StoreFit(spectra, f1, omg1, f1_noise, omg1_noise, popt1, pcov1, pred1, fixed_q=None):
+    """
+    Store the fitted parameters, the fit residuals and the band-limited spectra in a Spectra object.
 
-    # Predicted Spectrum
-    #pred1 = SourceSpectraTheo(f1, popt1[0], popt1[1], popt1[2], popt1[3])
-    #pred1 = SourceSpectraTheo(f1, popt1[0], popt1[1], popt1[2])
-    pred1 = SourceSpectraTheo(f1, *popt1)
+    Parameters:
+        spectra (Spectra): Spectra object containing spectral data.
+        f1, omg1 (numpy.ndarray): Frequencies and amplitudes of the fitted signal spectrum.
+        f1_noise, omg1_noise (numpy.ndarray): Frequencies and amplitudes of the noise spectrum.
+        popt1 (numpy.ndarray): Fitted omega, Fc and Q.
+        pcov1 (numpy.ndarray): Errors of the fitted parameters.
+        pred1 (numpy.ndarray): Predicted spectrum.
+        fixed_q (float, optional): The fixed Q of the station-constrained attenuation mode.
 
+    Returns:
+        Spectra: Spectra object with fitted parameters and updated data.
+    """
     DeltaOmega = np.log10(omg1[0]) - np.log10(omg1[-1])
 
     # Residuals and RMS (1 type)
-    omg1 = np.array(omg1)
     residuals1 = omg1 - pred1
     fres1 = sum(abs(residuals1 / omg1)) / len(omg1)
 
@@ -202,7 +871,8 @@ def SpectraFitting(cfg, spectra, phase):
         'QErr': pcov1[2],      
         'Rms1': fres1,
         'Rms2': RES_fc,
-        'DeltaOmega': DeltaOmega
+        'DeltaOmega': DeltaOmega,
+        'FixedQ': np.nan if fixed_q is None else fixed_q
     }
 
 
@@ -214,3 +884,75 @@ def SpectraFitting(cfg, spectra, phase):
     spectra.CalculatedSpectrum = pred1
 
     return spectra
+
+
+def RestoreFit(cfg, spectra, CurveFit, phase):
+    """
+    Store a known fit in a Spectra object computed again, without fitting it: the spectra are cut
+    to the fitting band and the predicted spectrum is evaluated, as done by StoreFit.
+
+    Parameters:
+        cfg (dict): Configuration parameters from the TESLA package.
+        spectra (Spectra): Spectra object containing spectral data.
+        CurveFit (dict): The fit of the spectra (see StoreFit).
+        phase (str): Seismic phase ('P' or 'S').
+
+    Returns:
+        Spectra: Spectra object with the fit and the band-limited spectra.
+    """
+    f1, omg1, f1_noise, omg1_noise, tt = FittingBand(cfg, spectra, phase)
+    model = GetKernels(cfg["CurveFitting"].get("Backend", "numpy"))['model']
+
+    spectra.CurveFit = CurveFit
+    spectra.SigSpectrum = omg1
+    spectra.NoiseSpectrum = omg1_noise
+    spectra.SigFrequencies = f1
+    spectra.NoiseFrequencies = f1_noise
+    spectra.CalculatedSpectrum = model(f1, CurveFit['Omega0'], CurveFit['Fc'], CurveFit['Q'], tt)
+
+    return spectra
+
+
+def SpectraFitting(cfg, spectra, phase, p0=None):
+    """
+    Perform curve fitting on seismic spectra.
+
+    Parameters:
+        cfg (dict): Configuration parameters from the TESLA package.
+        spectra (Spectra): Spectra object containing spectral data.
+        phase (str): Seismic phase ('P' or 'S').
+        p0 (tuple, optional): Warm-start omega, Fc and Q (e.g. the fit of the previous window).
+            The warm-started fit is kept only if it is within the bounds and its normalized RMS
+            does not exceed SpectraSelection.RmsNormThr; otherwise the global search is run.
+
+    Returns:
+        Spectra: Spectra object with fitted parameters and updated data.
+
+    Note:
+        If a fixed Q is configured for the station (see StationQ), only omega and Fc are fitted
+        and the fixed value is stored in CurveFit['FixedQ'].
+    """
+    # Get configuration parameters
+    ParameterBounds=[tuple(cfg["CurveFitting"]["OmegaBounds"]), tuple(cfg["CurveFitting"]["FcBounds"]), tuple(cfg["CurveFitting"]["QBounds"])]
+    f1, omg1, f1_noise, omg1_noise, tt = FittingBand(cfg, spectra, phase)
+
+    # A single spectrum of the batched engine is fitted with its per-spectrum counterpart
+    engine = cfg["CurveFitting"].get("Engine", "de+lm")
+    if engine == BATCH_ENGINE:
+        engine = 'table+lm'
+
+    # Curve Fitting
+    #popt1, pcov1 = curve_fit(SourceSpectraTheo, f1, omg1, method='trf', bounds=([min(spectra.SigSpectrum), 5, 1], [max(spectra.SigSpectrum), 80, 900]) )
+    #Basin Hopping
+    #minimizer_kwargs = {"method": "L-BFGS-B", "bounds": ParameterBounds}
+    #res = basinhopping(calculateSSE, x0=OptimalParameters, niter=200, minimizer_kwargs=minimizer_kwargs)
+    #popt1=res.x
+    fixed_q = StationQ(cfg, spectra.station, phase, tt)
+    fitter = SpectrumFitter(f1, omg1, tt, DifferentialEvolutionOptions(cfg), cfg["CurveFitting"].get("TableNodes", TABLE_NODES),
+                            cfg["CurveFitting"].get("Backend", "numpy"), fixed_q)
+    popt1, pcov1 = fitter.fit(ParameterBounds, engine, p0, cfg["SpectraSelection"]["RmsNormThr"])
+
+    # Predicted Spectrum
+    pred1 = fitter.model(f1, *popt1)
+
+    return StoreFit(spectra, f1, omg1, f1_noise, omg1_noise, popt1, pcov1, pred1, fixed_q)
@@ -0,0 +1,195 @@
+# encoding: utf8
+#!/usr/bin/env python
+
+"""
+This function is part of TESLA (Tool for automatic Earthquake low‐frequency Spectral Level estimAtion).
+
+EUROPEAN UNION PUBLIC LICENCE v. 1.2
+EUPL © the European Union 2007, 2016
+
+Copyright (C) 2023 Guido Maria Adinolfi, University of Turin, Turin, Italy. For inquiries, contact: guidomaria.adinolfi@unito.it
+
+Packed event archive: the waveforms of an event directory are stored in a single file, made of
+a JSON header index (one entry per SAC file, with the trace metadata and the SAC header) followed
+by the samples of all the traces, each stored with the data type it is read with (little-endian).
+The samples are read through a copy-on-write memory map, so repeated runs and worker processes
+share the pages of the file instead of decoding SAC files.
+
+Dependencies:
+- json
+- numpy
+- obspy
+- os
+"""
+
+import json
+import os
+import numpy as np
+from obspy import read, Stream, Trace, UTCDateTime
+from obspy.core.util import AttribDict
+
+ARCHIVE_NAME = 'waveforms.tesla'
+ARCHIVE_MAGIC = b'TESLAPK1'
+ARCHIVE_ALIGN = 64
+ARCHIVE_VERSION = 2
+
+_archives = {}
+
+
+def _HeaderValue(value):
+    """
+    Convert a SAC header value to a JSON serializable type.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def PackEvent(path_event_id, ext, filename=None):
+    """
+    Pack the waveform files of an event directory into a single archive.
+
+    Parameters:
+        path_event_id (str): The event directory.
+        ext (str): Extension of the waveform files.
+        filename (str, optional): The archive file (default: ARCHIVE_NAME in the event directory).
+
+    Returns:
+        filename (str): The archive file.
+        ntraces (int): Number of packed traces.
+    """
+
+    if filename is None:
+        filename = os.path.join(path_event_id, ARCHIVE_NAME)
+
+    traces = []
+    blocks = []
+    offset = 0
+
+    for name in sorted(os.listdir(path_event_id)):
+        if name.startswith('.') or name.split('.')[-1] != ext:
+            continue
+        for tr in read(os.path.join(path_event_id, name), debug_headers=True):
+            # The samples keep their data type, in little-endian byte order, so they are read back unchanged
+            data = np.require(tr.data, dtype=tr.data.dtype.newbyteorder('<'), requirements='C')
+            traces.append({'file': name,
+                           'network': tr.stats.network,
+                           'station': tr.stats.station,
+                           'location': tr.stats.location,
+                           'channel': tr.stats.channel,
+                           'starttime_ns': tr.stats.starttime.ns,
+                           'delta': tr.stats.delta,
+                           'npts': int(tr.stats.npts),
+                           'dtype': data.dtype.str,
+                           'offset': offset,
+                           'sac': {key: _HeaderValue(value) for key, value in tr.stats.get('sac', {}).items()}})
+            blocks.append(data)
+            offset += -(-data.nbytes // ARCHIVE_ALIGN) * ARCHIVE_ALIGN
+
+    header = json.dumps({'version': ARCHIVE_VERSION, 'traces': traces}).encode('utf8')
+    data_offset = -(-(len(ARCHIVE_MAGIC) + 8 + len(header)) // ARCHIVE_ALIGN) * ARCHIVE_ALIGN
+
+    # The archive is written to a new file that replaces the old one, so that the memory maps
+    # of the old archive still open in this process keep their own (unchanged) file
+    with open(filename + '.tmp', 'wb') as out:
+        out.write(ARCHIVE_MAGIC)
+        out.write(np.uint64(len(header)).tobytes())
+        out.write(header)
+        out.write(b'\0' * (data_offset - out.tell()))
+        for data in blocks:
+            out.write(data.tobytes())
+            out.write(b'\0' * (-data.nbytes % ARCHIVE_ALIGN))
+    os.replace(filename + '.tmp', filename)
+
+    return filename, len(traces)
+
+
+def OpenArchive(filename=ARCHIVE_NAME):
+    """
+    Open a packed event archive. The archive is opened once per process, and again if the
+    file is modified (e.g. packed again), since it is cached by path, modification time and size.
+
+    Parameters:
+        filename (str, optional): The archive file (default: ARCHIVE_NAME in the current directory).
+
+    Returns:
+        archive (dict): The header index ('traces'), the traces grouped by packed file ('files')
+            and the memory-mapped bytes of the samples ('data').
+
+    Notes:
+        - Version 2 archives store the data type and the byte offset of every trace. The traces
+          of version 1 archives, all of the header data type at element offsets, are converted
+          to the same form when the archive is opened.
+    """
+
+    filename = os.path.abspath(filename)
+
+    if not os.path.isfile(filename):
+        raise FileNotFoundError("No packed archive %s: run 'Tesla pack' on the event directory first" % (filename))
+
+    stat = os.stat(filename)
+    key = (filename, stat.st_mtime_ns, stat.st_size)
+
+    if key not in _archives:
+        for old in [old for old in _archives if old[0] == filename]:
+            del _archives[old]
+
+        with open(filename, 'rb') as inp:
+            if inp.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+                raise ValueError("%s is not a TESLA archive" % (filename))
+            header_len = int(np.frombuffer(inp.read(8), dtype=np.uint64)[0])
+            header = json.loads(inp.read(header_len).decode('utf8'))
+
+        if header['version'] == 1:
+            for tr in header['traces']:
+                tr['dtype'] = header['dtype']
+                tr['offset'] *= np.dtype(header['dtype']).itemsize
+
+        data_offset = -(-(len(ARCHIVE_MAGIC) + 8 + header_len) // ARCHIVE_ALIGN) * ARCHIVE_ALIGN
+        size = stat.st_size - data_offset
+        data = np.memmap(filename, dtype=np.uint8, mode='c', offset=data_offset, shape=(size,)) if size > 0 else np.zeros(0, dtype=np.uint8)
+
+        files = {}
+        for tr in header['traces']:
+            files.setdefault(tr['file'], []).append(tr)
+
+        _archives[key] = {'traces': header['traces'], 'files': files, 'data': data}
+
+    return _archives[key]
+
+
+def ArchiveFiles(archive):
+    """
+    Return the names of the SAC files packed in an archive.
+    """
+    return sorted(archive['files'])
+
+
+def ArchiveStream(archive, files):
+    """
+    Build the Stream of the given packed files. The trace data are views of the memory map.
+
+    Parameters:
+        archive (dict): The archive returned by OpenArchive.
+        files (list): Names of the packed SAC files.
+
+    Returns:
+        st (Stream): The traces of the files, in the order of files.
+    """
+
+    st = Stream()
+
+    for name in files:
+        for tr in archive['files'].get(name, []):
+            dtype = np.dtype(tr['dtype'])
+            data = archive['data'][tr['offset']:tr['offset'] + tr['npts'] * dtype.itemsize]
+            trace = Trace(data=data.view(np.ndarray).view(dtype),
+                          header={'network': tr['network'], 'station': tr['station'],
+                                  'location': tr['location'], 'channel': tr['channel'],
+                                  'starttime': UTCDateTime(ns=tr['starttime_ns']),
+                                  'delta': tr['delta']})
+            trace.stats.sac = AttribDict(tr['sac'])
+            trace.stats._format = 'SAC'
+            st.append(trace)
+
+    return st
@@ -0,0 +1,215 @@
+# encoding: utf8
+#!/usr/bin/env python
+
+"""
+This function is part of TESLA (Tool for automatic Earthquake low‐frequency Spectral Level estimAtion).
+
+EUROPEAN UNION PUBLIC LICENCE v. 1.2
+EUPL © the European Union 2007, 2016
+
+Copyright (C) 2023 Guido Maria Adinolfi, University of Turin, Turin, Italy. For inquiries, contact: guidomaria.adinolfi@unito.it
+
+Joint multi-station inversion: the best selected spectra of all the stations of an event are
+inverted together for a single corner frequency (one per phase, or one for the whole event)
+plus the low-frequency level and t* = tt/Q of every station. The log-amplitude residuals of
+all the spectra are minimized with a bounded least-squares solver and a sparse Jacobian: the
+corner frequency column is dense, while each station only has its own Omega0 and t* columns.
+
+Dependencies:
+- numpy
+- os
+- pandas
+- scipy
+- tesla.curve_fitting
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from scipy.optimize import least_squares
+from scipy.sparse import csr_matrix
+from tesla.curve_fitting import StationQ
+
+#Modes of JointInversion.SharedFc
+SHARED_FC = ['phase', 'event']
+
+
+def JointInversion(cfg, spectra):
+    """
+    Invert the spectra of several stations for a shared corner frequency.
+
+    The model of each spectrum is ln A = ln Omega0 - pi f t* - ln(1 + (f/Fc)^2). The residuals of
+    each spectrum are weighted by 1/sqrt(npts), so every station has the same weight whatever the
+    number of its frequencies. The frequency bins with a zero (or not finite) amplitude have no
+    logarithm and are left out; a spectrum with fewer than 3 such bins is not inverted. The starting
+    values are the single-station fits (CurveFit), with the median Fc of the stations. The t* of a
+    station with a fixed Q (see curve_fitting.StationQ) is not inverted.
+
+    The parameter errors are those of the covariance inv(J^T J) * 2 cost / dof. J^T J has an
+    arrowhead structure (one 2x2 block per station plus the Fc row and column), so its inverse is
+    obtained with the Schur complement of the Fc term, at a cost linear in the number of stations.
+
+    Parameters:
+        cfg (dict): Configuration parameters from the TESLA package.
+        spectra (list): (phase, station, Spectra) of the best selected spectrum of each station.
+
+    Returns:
+        DataFrame: One row per inverted spectrum, with the shared Corner_Frequency and the Omega0, t*
+            and Q of the station, their errors and the normalized RMS of the joint model.
+    """
+
+    (DCmin, DCmax), (fcmin, fcmax), (Qmin, Qmax) = [tuple(cfg["CurveFitting"][key]) for key in ("OmegaBounds", "FcBounds", "QBounds")]
+
+    # Frequency bins with a positive amplitude (the model is fitted to the log-amplitudes)
+    masks = []
+    for phase, sta, spectrum in spectra:
+        f_s = np.asarray(spectrum.SigFrequencies, dtype=float)
+        A_s = np.abs(np.asarray(spectrum.SigSpectrum, dtype=float))
+        masks.append(np.isfinite(f_s) & (f_s > 0) & np.isfinite(A_s) & (A_s > 0))
+    keep = [mask.sum() >= 3 for mask in masks]
+    spectra = [item for item, k in zip(spectra, keep) if k]
+    masks = [mask for mask, k in zip(masks, keep) if k]
+    if not spectra:
+        raise ValueError("No spectra with positive amplitudes for the joint inversion")
+
+    N = len(spectra)
+    f, lnA, sta_index, weight, tt, fixed_ts = [], [], [], [], [], []
+
+    for s, ((phase, sta, spectrum), mask) in enumerate(zip(spectra, masks)):
+        f_s = np.asarray(spectrum.SigFrequencies, dtype=float)[mask]
+        f.append(f_s)
+        lnA.append(np.log(np.abs(np.asarray(spectrum.SigSpectrum, dtype=float))[mask]))
+        sta_index.append(np.full(len(f_s), s))
+        weight.append(np.full(len(f_s), 1. / np.sqrt(len(f_s))))
+        tt.append(spectrum.Ptraveltime if phase == 'P' else spectrum.Straveltime)
+        fixed_q = StationQ(cfg, sta, phase, tt[-1])
+        fixed_ts.append(np.nan if fixed_q is None else tt[-1] / fixed_q)
+
+    # The spectra are contiguous: the frequencies of station s are f[start[s]:start[s + 1]]
+    start = np.cumsum([0] + [len(f_s) for f_s in f])
+    f, lnA, sta_index, weight = np.concatenate(f), np.concatenate(lnA), np.concatenate(sta_index), np.concatenate(weight)
+    tt, fixed_ts = np.array(tt, dtype=float), np.array(fixed_ts)
+    M = len(f)
+
+    # Parameters: Fc, ln Omega0 of each station, t* of each station without a fixed Q
+    free_ts = np.isnan(fixed_ts)
+    ts_col = np.full(N, -1)
+    ts_col[free_ts] = 1 + N + np.arange(free_ts.sum())
+    P = 1 + N + int(free_ts.sum())
+
+    fit = [spectrum.CurveFit for phase, sta, spectrum in spectra]
+    fc0 = np.nanmedian([c['Fc'] for c in fit])
+    lnDC0 = np.log([c['Omega0'] for c in fit])
+    ts0 = tt / np.array([c['Q'] for c in fit], dtype=float)
+
+    lower = np.concatenate([[fcmin], np.full(N, np.log(DCmin)), (tt / Qmax)[free_ts]])
+    upper = np.concatenate([[fcmax], np.full(N, np.log(DCmax)), (tt / Qmin)[free_ts]])
+    x0 = np.concatenate([[fc0], lnDC0, ts0[free_ts]])
+    x0 = np.where(np.isfinite(x0), x0, (lower + upper) / 2.)
+    x0 = np.clip(x0, lower + 1e-9 * (upper - lower), upper - 1e-9 * (upper - lower))
+
+    def station_ts(x):
+        ts = fixed_ts.copy()
+        ts[free_ts] = x[1 + N:]
+        return ts
+
+    def residuals(x):
+        return weight * (x[1 + sta_index] - np.pi * f * station_ts(x)[sta_index] - np.log1p((f / x[0]) ** 2) - lnA)
+
+    # Sparsity pattern of the Jacobian: Fc column, Omega0 column of the station, t* column of the station
+    has_ts = ts_col[sta_index] >= 0
+    rows = np.concatenate([np.arange(M), np.arange(M), np.flatnonzero(has_ts)])
+    cols = np.concatenate([np.zeros(M, dtype=int), 1 + sta_index, ts_col[sta_index][has_ts]])
+
+    def derivatives(x):
+        r = (f / x[0]) ** 2
+        return weight * 2. * r / (x[0] * (1. + r)), weight, -weight * np.pi * f
+
+    def jacobian(x):
+        d_fc, d_dc, d_ts = derivatives(x)
+        return csr_matrix((np.concatenate([d_fc, d_dc, d_ts[has_ts]]), (rows, cols)), shape=(M, P))
+
+    res = least_squares(residuals, x0, jac=jacobian, bounds=(lower, upper), method='trf', x_scale='jac')
+
+    # Covariance of the arrowhead J^T J: station blocks B, coupling c with Fc, Schur complement of Fc
+    d_fc, d_dc, d_ts = derivatives(res.x)
+    s2 = 2. * res.cost / max(M - P, 1)
+    blocks = []
+    schur = np.sum(d_fc ** 2)
+    for s in range(N):
+        k = slice(start[s], start[s + 1])
+        Js = np.column_stack([d_dc[k], d_ts[k]]) if free_ts[s] else d_dc[k][:, None]
+        Binv = np.linalg.pinv(Js.T @ Js)
+        c = Js.T @ d_fc[k]
+        u = Binv @ c
+        schur -= c @ u
+        blocks.append((Binv, u))
+
+    fc = res.x[0]
+    fc_err = np.sqrt(s2 / schur) if schur > 0 else np.inf
+    lnDC = res.x[1:1 + N]
+    ts = station_ts(res.x)
+
+    results = []
+    for s, (phase, sta, spectrum) in enumerate(spectra):
+        Binv, u = blocks[s]
+        err = np.sqrt(np.abs(s2 * (np.diag(Binv) + u ** 2 / schur))) if schur > 0 else np.full(len(u), np.inf)
+        DC1 = np.exp(lnDC[s])
+        ts_err = err[1] if free_ts[s] else 0.
+
+        k = slice(start[s], start[s + 1])
+        model = np.exp(lnDC[s] - np.pi * f[k] * ts[s] - np.log1p((f[k] / fc) ** 2))
+        obs = np.exp(lnA[k])
+
+        results.append({'Phase': phase,
+                        'Station': sta,
+                        'No.': int(str(spectrum.id).split('.')[0]),
+                        'Omega0': DC1,
+                        'Omega0_Error': DC1 * err[0],
+                        'Corner_Frequency': fc,
+                        'Corner_Frequency_Error': fc_err,
+                        'TStar': ts[s],
+                        'TStar_Error': ts_err,
+                        'Q': tt[s] / ts[s],
+                        'Q_Error': tt[s] / ts[s] ** 2 * ts_err,
+                        'RMS_Normalized': np.mean(np.abs((obs - model) / obs)) * 100})
+
+    return pd.DataFrame(results, columns=['Phase', 'Station', 'No.', 'Omega0', 'Omega0_Error', 'Corner_Frequency',
+                                          'Corner_Frequency_Error', 'TStar', 'TStar_Error', 'Q', 'Q_Error', 'RMS_Normalized'])
+
+
+def RunJointInversion(cfg, spectra):
+    """
+    Run the joint inversion on the best selected spectra of the event and save the results.
+
+    With JointInversion.SharedFc 'phase' (default) the spectra of each phase are inverted for
+    their own corner frequency and the results are written to <phase>/Joint_Source_Spectra.csv,
+    next to the station directories; with 'event' all the spectra share one corner frequency
+    and the results are written to Joint_Source_Spectra.csv in the event directory.
+
+    Parameters:
+        cfg (dict): Configuration parameters from the TESLA package.
+        spectra (list): (phase, station, Spectra) of the best selected spectrum of each station.
+
+    Returns:
+        dict: The DataFrame of the results, for each output file.
+    """
+
+    shared = cfg["JointInversion"].get("SharedFc", "phase")
+    if shared not in SHARED_FC:
+        raise ValueError("JointInversion SharedFc must be one of %s" % (SHARED_FC))
+
+    if shared == 'event':
+        groups = {'Joint_Source_Spectra.csv': spectra}
+    else:
+        groups = {}
+        for item in spectra:
+            groups.setdefault(os.path.join(item[0], 'Joint_Source_Spectra.csv'), []).append(item)
+
+    results = {}
+    for filename, group in groups.items():
+        df = JointInversion(cfg, group)
+        df.to_csv(filename, index=False)
+        results[filename] = df
+
+    return results
@@ -0,0 +1,155 @@
+# encoding: utf8
+#!/usr/bin/env python
+
+"""
+This function is part of TESLA (Tool for automatic Earthquake low‐frequency Spectral Level estimAtion).
+
+EUROPEAN UNION PUBLIC LICENCE v. 1.2
+EUPL © the European Union 2007, 2016
+
+Copyright (C) 2023 Guido Maria Adinolfi, University of Turin, Turin, Italy. For inquiries, contact: guidomaria.adinolfi@unito.it
+
+Registry of the kernels of the curve fitting: theoretical spectrum ('model'), sum of squared
+errors ('sse'), log-amplitude residuals ('log_residuals') and their Jacobian ('log_jacobian').
+The NumPy kernels are always registered; if numba is installed, compiled versions of the same
+kernels are registered as the 'numba' backend.
+
+Dependencies:
+- numpy
+- numba (optional)
+- tesla.source_spectrum_function
+- warnings
+"""
+
+import warnings
+import numpy as np
+from tesla.source_spectrum_function import SourceSpectraTheo
+
+#Backends selectable with CurveFitting.Backend ('auto' selects numba when it is installed)
+BACKENDS = ['numpy', 'numba', 'auto']
+
+KERNELS = {}
+
+
+def RegisterKernels(backend, model, sse, log_residuals, log_jacobian):
+    """
+    Register the kernels of a backend.
+    """
+    KERNELS[backend] = {'model': model, 'sse': sse, 'log_residuals': log_residuals, 'log_jacobian': log_jacobian}
+
+
+def GetKernels(backend='numpy'):
+    """
+    Return the kernels of a backend.
+
+    Parameters:
+        backend (str, optional): One of BACKENDS. If 'numba' is requested but numba is not
+            installed, the NumPy kernels are returned with a warning.
+
+    Returns:
+        dict: The 'model', 'sse', 'log_residuals' and 'log_jacobian' kernels.
+    """
+    if backend not in BACKENDS:
+        raise ValueError("CurveFitting Backend must be one of %s" % (BACKENDS))
+
+    if backend == 'auto':
+        backend = 'numba' if 'numba' in KERNELS else 'numpy'
+
+    if backend not in KERNELS:
+        warnings.warn("The %s backend is not available (is it installed?): using the numpy kernels" % (backend))
+        backend = 'numpy'
+
+    return KERNELS[backend]
+
+
+def ModelSSE(parameterTuple, f1, omg1, tt):
+    """
+    Sum of Squared Errors between the observed spectrum and the model for (omega, Fc, Q), or for
+    an array of shape (3, S) with a population of S parameter sets.
+    """
+    DC1, fc1, Q = np.asarray(parameterTuple, dtype=float)[..., None]
+    theo_spctr = SourceSpectraTheo(f1, DC1, fc1, Q, tt)
+
+    return np.sum((omg1 - theo_spctr) ** 2.0, axis=-1)
+
+
+def LogResiduals(x, f1, omg1, tt):
+    """
+    Log-amplitude residuals of the model for x = (ln omega, Fc, Q).
+    """
+    lnDC1, fc1, Q = x
+    return lnDC1 - np.pi * f1 * tt / Q - np.log1p((f1 / fc1) ** 2) - np.log(omg1)
+
+
+def LogJacobian(x, f1, tt):
+    """
+    Analytic Jacobian of the log-amplitude residuals with respect to (ln omega, Fc, Q).
+    """
+    lnDC1, fc1, Q = x
+    r = (f1 / fc1) ** 2
+    J = np.empty((f1.size, 3))
+    J[:, 0] = 1.
+    J[:, 1] = 2. * r / (fc1 * (1. + r))
+    J[:, 2] = np.pi * f1 * tt / Q ** 2
+    return J
+
+
+RegisterKernels('numpy', SourceSpectraTheo, ModelSSE, LogResiduals, LogJacobian)
+
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _ModelNumba(f1, DC1, fc1, Q, tt):
+        out = np.empty(f1.size)
+        for k in range(f1.size):
+            out[k] = DC1 * np.exp(-np.pi * f1[k] * tt / Q) / (1. + (f1[k] / fc1) ** 2)
+        return out
+
+    @numba.njit(cache=True)
+    def _SSENumba(params, f1, omg1, tt):
+        sse = np.zeros(params.shape[1])
+        for s in range(params.shape[1]):
+            DC1, fc1, Q = params[0, s], params[1, s], params[2, s]
+            for k in range(f1.size):
+                d = omg1[k] - DC1 * np.exp(-np.pi * f1[k] * tt / Q) / (1. + (f1[k] / fc1) ** 2)
+                sse[s] += d * d
+        return sse
+
+    @numba.njit(cache=True)
+    def _LogResidualsNumba(x, f1, omg1, tt):
+        out = np.empty(f1.size)
+        for k in range(f1.size):
+            out[k] = x[0] - np.pi * f1[k] * tt / x[2] - np.log1p((f1[k] / x[1]) ** 2) - np.log(omg1[k])
+        return out
+
+    @numba.njit(cache=True)
+    def _LogJacobianNumba(x, f1, tt):
+        J = np.empty((f1.size, 3))
+        for k in range(f1.size):
+            r = (f1[k] / x[1]) ** 2
+            J[k, 0] = 1.
+            J[k, 1] = 2. * r / (x[1] * (1. + r))
+            J[k, 2] = np.pi * f1[k] * tt / x[2] ** 2
+        return J
+
+    def _ModelNumbaKernel(f1, DC1, fc1, Q, tt):
+        return _ModelNumba(np.asarray(f1, dtype=float), float(DC1), float(fc1), float(Q), float(tt))
+
+    def _SSENumbaKernel(parameterTuple, f1, omg1, tt):
+        params = np.asarray(parameterTuple, dtype=float)
+        sse = _SSENumba(np.ascontiguousarray(params.reshape(3, -1)), np.asarray(f1, dtype=float), np.asarray(omg1, dtype=float), float(tt))
+        return sse[0] if params.ndim == 1 else sse
+
+    def _LogResidualsNumbaKernel(x, f1, omg1, tt):
+        return _LogResidualsNumba(np.asarray(x, dtype=float), f1, omg1, float(tt))
+
+    def _LogJacobianNumbaKernel(x, f1, tt):
+        return _LogJacobianNumba(np.asarray(x, dtype=float), f1, float(tt))
+
+    RegisterKernels('numba', _ModelNumbaKernel, _SSENumbaKernel, _LogResidualsNumbaKernel, _LogJacobianNumbaKernel)
@@ -18,6 +18,8 @@ Copyright (C) 2023 Guido Maria Adinolfi, University of Turin, Turin, Italy. For
 
 Dependencies:
 - argparse
+- concurrent.futures
+- glob
 - rich
 - sys
 - time
@@ -38,11 +40,15 @@ from rich.table import Table
 from rich.progress import Progress
 import time
 import sys
+import glob
 import yaml
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from tesla.calc_travel_time import *
 from tesla.class_spectra import *
 from tesla.curve_fitting import *
+from tesla.event_archive import *
+from tesla.joint_inversion import *
 from tesla.load_object import *
 from tesla.plot_spectra import *
 from tesla.read_config import *
@@ -68,8 +74,78 @@ custom_theme = Theme({
 # Create a Rich console instance with the custom theme
 console = Console(theme=custom_theme, record=True, log_time_format='%Y-%m-%d %H:%M:%S.%f', file="")
 
+class LogRecorder:
+    """
+    Console stand-in used inside worker processes.
+
+    The worker cannot write to the parent's Rich console, so every log/print call is
+    recorded and sent back with the results. The parent replays the records on its
+    own console once it handles the corresponding station task.
+    """
+    def __init__(self):
+        self.records = []
+
+    def log(self, *objects, **kwargs):
+        self.records.append(("log", objects, kwargs))
+
+    def print(self, *objects, **kwargs):
+        self.records.append(("print", objects, kwargs))
+
+
+def ReplayLog(console, records):
+    """
+    Replay the log records collected by a LogRecorder on the given console.
+    """
+    for method, objects, kwargs in records:
+        getattr(console, method)(*objects, **kwargs)
+
+
+def StationProcessingTask(path_event_id, config, sta, index=None, archive_file=None):
+    """
+    Run the Waveform Processing of every phase of one station in a worker process.
+
+    The station is read and preprocessed once and its stream and noise spectra are
+    shared between the phases.
+
+    Parameters:
+        path_event_id (str): The event directory.
+        config (dict): Configuration parameters.
+        sta (str): The name of the seismic station.
+        index (dict, optional): Index of the event files built by the parent process
+            (see IndexEventDirectory), so that the worker does not list the directory again.
+        archive_file (str, optional): Packed archive of the event, if Files.Layout is 'archive'.
+            The archive is opened once per worker process.
+
+    Returns:
+        results (dict): (SpectraList, Wvfrms, records) tuples keyed by phase, where records
+            are the log records to be replayed by the parent process.
+    """
+    os.chdir(path_event_id)
+    results = {}
+    recorder = LogRecorder()
+    archive = OpenArchive(archive_file) if archive_file is not None else None
+    st = LoadStation(config, sta, recorder, index, archive)
+    noise_cache = {}
+    # The pool of the signal windows lasts for the task: a worker process cannot exit
+    # while the processes of a pool it owns are alive
+    window_executor = WindowExecutor(config) if st is not None else None
+    try:
+        for phase in config["SourceSpectra"]["Phase"]:
+            if st is None:
+                results[phase] = ([], [], recorder.records)
+            else:
+                SpectraList, Wvfrms, _ = WaveformProcessing(config, sta, phase, recorder, noise_cache, st, window_executor)
+                results[phase] = (SpectraList, Wvfrms, recorder.records)
+            recorder = LogRecorder()
+    finally:
+        if window_executor is not None:
+            window_executor.shutdown()
+
+    return results
+
+
 # Define the main function that processes the data
-def RunTesla(Event_id, Configuration_file):
+def RunTesla(Event_id, Configuration_file, workers=1):
 
 
     working_dir=os.getcwd()
@@ -103,6 +179,47 @@ def RunTesla(Event_id, Configuration_file):
     console.print(" ")
     time.sleep(1) 
     
+    # Index of the waveform files of the event, built once for all the stations, and
+    # packed archive of the event if the waveforms are read from it
+    archive = None
+    archive_file = None
+    try:
+        if config["Files"].get("Layout", "sac") == "archive":
+            archive_file = os.path.abspath(ARCHIVE_NAME)
+            archive = OpenArchive(archive_file)
+            index = IndexEventDirectory(config["Files"]["ext"], names=ArchiveFiles(archive))
+        else:
+            index = IndexEventDirectory(config["Files"]["ext"])
+    except:
+        console.print_exception()
+        console.save_html("logfile")
+        raise
+
+    # Schedule the Waveform Processing of every station on a process pool, one task per
+    # station with the index entries of the station and the path of the archive.
+    # Results are collected below in the serial order, so the parent keeps the console,
+    # the progress bars and the output layout (selection, plots and saved objects).
+    executor = None
+    window_executor = None
+    futures = {}
+    if workers > 1:
+        console.log("[info]INFO:[/info]     [normal]Running Waveform Processing on %d worker processes" % (workers))
+        executor = ProcessPoolExecutor(max_workers=workers)
+        for sta in config["Files"]["stations"]:
+            futures[sta] = executor.submit(StationProcessingTask, path_event_id, config, sta, {sta: index.get(sta, [])}, archive_file)
+    else:
+        # Pool of workers for the signal windows, shared by all the stations and phases
+        window_executor = WindowExecutor(config)
+
+    # Preprocessed waveforms and noise spectra cached per station, so that the S phase
+    # reuses the stream and the noise windows of the P phase
+    streams = {}
+    noise_caches = {}
+
+    # Best selected spectrum of every station and phase, for the joint inversion
+    joint_spectra = []
+    joint_inversion = config.get("JointInversion", {}).get("Enable", False)
+
     # Calculate total tasks
     tot1 = len(config["SourceSpectra"]["Phase"]) * len(config["Files"]["stations"])
     tot2 = len(config["Files"]["stations"])
@@ -144,11 +261,31 @@ def RunTesla(Event_id, Configuration_file):
                 # Waveform Processing
                 console.log("[info]INFO:[/info]     [normal]Waveform Processing")
                 try:
-                    SpectraList, Wvfrms, Consol = WaveformProcessing(config, sta, phase, console)
+                    if executor is not None:
+                        future = futures[sta]
+                        if phase == config["SourceSpectra"]["Phase"][-1]:
+                            futures.pop(sta)
+                        results = future.result()
+                        SpectraList, Wvfrms, records = results[phase]
+                        ReplayLog(console, records)
+                    else:
+                        if sta not in streams:
+                            streams[sta] = LoadStation(config, sta, console, index, archive)
+                        st = streams[sta]
+                        noise_cache = noise_caches.setdefault(sta, {})
+                        if phase == config["SourceSpectra"]["Phase"][-1]:
+                            streams.pop(sta)
+                            noise_caches.pop(sta)
+                        if st is None:
+                            SpectraList, Wvfrms = [], []
+                        else:
+                            SpectraList, Wvfrms, Consol = WaveformProcessing(config, sta, phase, console, noise_cache, st, window_executor)
                     Consol = console
                 except:
                     console.print_exception()
+                    console.log("[warning]WARNING:[/warning]  [normal]Waveform Processing failed for station %s" % (sta))
                     console.save_html("logfile")
+                    SpectraList, Wvfrms = [], []
 
                 if not SpectraList:
                     continue
@@ -164,6 +301,8 @@ def RunTesla(Event_id, Configuration_file):
                 if not SpectraSelList:
                     console.log("[warning]WARNING:[/warning]  [normal]No Spectra for station %s" % (sta))
                     #time.sleep(1)
+                elif joint_inversion:
+                    joint_spectra.append((phase, sta, SpectraSelList[0]))
 
 
                 # Plotting Selected Spectra
@@ -251,6 +390,21 @@ def RunTesla(Event_id, Configuration_file):
         console.print(" ")
         console.print(" ")
     console.print(" ")
+
+    if executor is not None:
+        executor.shutdown()
+    if window_executor is not None:
+        window_executor.shutdown()
+
+    # Joint inversion of the best selected spectra of all the stations
+    if joint_spectra:
+        console.log("[info]INFO:[/info]     [normal]Joint Inversion of %d spectra" % (len(joint_spectra)))
+        try:
+            for filename, df in RunJointInversion(config, joint_spectra).items():
+                console.log("[info]INFO:[/info]     [normal]Corner Frequency %.3f Hz (%d spectra) saved to %s" % (df['Corner_Frequency'].iloc[0], len(df), filename))
+        except:
+            console.print_exception()
+            console.save_html("logfile")
     
     # Calculate end time and display end processing message
     t1_stop = process_time()
@@ -274,13 +428,32 @@ def RunTesla(Event_id, Configuration_file):
 #     # Call the main function with Event_id
 #     main(Event_id)
 
+def PackTesla(Event_id, ext):
+    """
+    Pack the waveform files of an event directory into a single archive (see tesla.event_archive).
+    """
+    console.log("[info]INFO:[/info]     [normal]Packing the waveforms of event %s" % (Event_id))
+    filename, ntraces = PackEvent(os.path.abspath(Event_id), ext)
+    console.log("[info]INFO:[/info]     [normal]%d traces packed in %s" % (ntraces, filename))
+
+
 def main():
+        if len(sys.argv) > 1 and sys.argv[1] == 'pack':
+            parser = argparse.ArgumentParser(prog='Tesla pack')
+            parser.add_argument('-e', '--earthquake_id', action="store", help='Provide Earthquake Id', required=True)
+            parser.add_argument('-x', '--ext', action="store", default='SAC', help='Extension of the waveform files (default: SAC)')
+            args = parser.parse_args(sys.argv[2:])
+
+            PackTesla(args.earthquake_id, args.ext)
+            return
+
         parser = argparse.ArgumentParser()
         parser.add_argument('-e', '--earthquake_id', action="store", help='Provide Earthquake Id', required=True)
         parser.add_argument('-c', '--configuration_file', action="store", help='Provide Configuration File', required=True)
+        parser.add_argument('-w', '--workers', action="store", type=int, default=1, help='Number of worker processes, one task per station (default: 1)')
         args = parser.parse_args()
 
-        RunTesla(args.earthquake_id, args.configuration_file)
+        RunTesla(args.earthquake_id, args.configuration_file, workers=args.workers)
 
 
 if __name__ == ' __main__':
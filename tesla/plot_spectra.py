@@ -49,6 +49,9 @@ def PlotSpectraLoop(SpectraList,wvfrms,cfg,sta,phase,console,show_figure=False,s
 
 	for Spectra in SpectraList:
 
+		#Spectra without spectral arrays (e.g. stripped in streaming mode) cannot be plotted
+		if len(Spectra.CalculatedSpectrum)==0:
+			continue
 
 		t1_sig=Spectra.SigWindTimes[0]
 		t2_sig=Spectra.SigWindTimes[1]
@@ -13,9 +13,8 @@ Dependencies:
 
 import numpy as np
 
-tt = []
 
-def SourceSpectraTheo(f1, DC1, fc1, Q):
+def SourceSpectraTheo(f1, DC1, fc1, Q, tt):
     """
     Define the theoretical function for the source spectra (from Abercrombie 1995).
 
@@ -24,15 +23,15 @@ def SourceSpectraTheo(f1, DC1, fc1, Q):
         DC1 (float): Amplitude scaling factor.
         fc1 (float): Corner frequency.
         Q (float): Quality factor.
+        tt (float): Travel time of the phase.
 
     Returns:
         numpy.ndarray: Theoretical source spectra.
 
     Note:
-        This function is based on the formula from Abercrombie 1995.
+        This function is based on the formula from Abercrombie 1995, with gamma = 1 and n = 2.
+        DC1, fc1 and Q can also be arrays of shape (S, 1): the S models are then evaluated
+        in one broadcast call and the result has shape (S, len(f1)).
     """
-    gamma1 = 1
-    n1 = 2
-    f1 = np.asarray(f1)
-    b = -1. * ((np.pi * f1 * tt) / Q)
-    return (DC1 * np.e ** (b) / (1. + (f1 / fc1) ** (gamma1 * n1)) ** (1. / gamma1))
+    f1 = np.asarray(f1, dtype=float)
+    return DC1 * np.exp(-np.pi * f1 * tt / Q) / (1. + (f1 / fc1) ** 2)
@@ -8,13 +8,17 @@ EUPL © the European Union 2007, 2016
 Copyright (C) 2023 Guido Maria Adinolfi, University of Turin, Turin, Italy. For inquiries, contact: guidomaria.adinolfi@unito.it
 
 Dependencies:
-- math
+- collections
+- functools
 - matplotlib
 - numpy
 - obspy
+- scipy
 - tesla.smooth 
 - tesla.class_spectra
 - tesla.calc_travel_time
+- threading
+- warnings
 """
 
 from obspy.core import trace
@@ -22,11 +26,28 @@ from tesla.smooth import smooth
 from tesla.class_spectra import Spectra
 from tesla.calc_travel_time import CalcTravelTime
 import numpy as np
-from math import sqrt
 from matplotlib import pyplot as plt
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+import warnings
+from scipy.signal import detrend, welch
+from scipy.signal.windows import hann
 
 
-def SpectraProcessing(cfg, id, st, i, j, sta, phase):
+#Maximum number of windows transformed together by the batch engine (bounds the memory of the 2-D arrays)
+BATCH_ROWS = 256
+
+#Maximum memory (in bytes) of the DFT bases cached by _DFTBasis in each process
+DFT_BASIS_CACHE_BYTES = 64 * 2**20
+
+#Cached DFT bases, least recently used first, their total size and the lock shared by the threads
+_dft_bases = OrderedDict()
+_dft_bases_bytes = [0]
+_dft_bases_lock = Lock()
+
+
+def SpectraProcessing(cfg, id, st, i, j, sta, phase, noise_cache=None):
     """
     Perform Spectra Processing on seismic data.
 
@@ -38,6 +59,8 @@ def SpectraProcessing(cfg, id, st, i, j, sta, phase):
         j (float): End time window for processing.
         sta (str): Station identifier.
         phase (str): Seismic phase ('P' or 'S').
+        noise_cache (dict): Optional cache of the smoothed noise spectra of the station, keyed
+            by the sample range and padding of the noise window (see NoiseCacheKey).
 
     Notes:
         - This function performs Spectra Processing on seismic data, including signal padding, spectrum calculation, and more.
@@ -53,6 +76,21 @@ def SpectraProcessing(cfg, id, st, i, j, sta, phase):
         S = st[0].stats.sac.t0
         Pick = S
 
+    win_dur = ((Pick + j)) - ((Pick - i))
+    if phase=="P":
+        NoiseWindTimes=[P-i-win_dur, P-i]
+    else:
+        NoiseWindTimes=[P-win_dur, P]
+
+    # --- Cached Noise Spectrum --- #
+    noise_key = NoiseCacheKey(cfg, st, NoiseWindTimes, win_dur)
+    cached_noise = noise_cache.get(noise_key) if noise_cache is not None else None
+
+    # --- Welch Noise Model of the station (replaces the noise window, if the station has one) --- #
+    welch_noise = WelchNoiseSpectrum(cfg, st, noise_key, noise_cache) if cfg["SourceSpectra"].get("NoiseModel", "window") == "welch" else None
+    if welch_noise is not None:
+        Fred_noise, PHTred_noise, NoiseWindTimes = welch_noise
+        cached_noise = (Fred_noise, PHTred_noise)
 
     for c in [0, 1, 2]:
         T = st[c].data
@@ -65,7 +103,6 @@ def SpectraProcessing(cfg, id, st, i, j, sta, phase):
         pht.stats.delta = delta
 
         # --- Signal Padding --- #
-        win_dur = ((Pick + j)) - ((Pick - i))
         tot_len = cfg["SourceSpectra"]["Padding"]
         pad_len_sec = (tot_len - win_dur) / 2
         pad_len_pts = int(pad_len_sec / pht.stats.delta)
@@ -89,7 +126,16 @@ def SpectraProcessing(cfg, id, st, i, j, sta, phase):
 
     #-----------------------------------------------------------------------------#
     #--Noise---#
-        
+
+        if cached_noise is not None:
+            if c == 0:
+                ZZ=np.abs(PHTred)
+            if c == 1:
+                NN=np.abs(PHTred)
+            if c == 2:
+                EE=np.abs(PHTred)
+            continue
+
         noise = trace.Trace()
         noise.stats.sampling_rate = sampRate
         noise.stats.delta = delta
@@ -134,34 +180,49 @@ def SpectraProcessing(cfg, id, st, i, j, sta, phase):
 
     #-----------------------------------------------------------------------------#
 
-    PHTred=[]
-    for ll in range(len(ZZ)):
-        vett=sqrt((np.power(ZZ[ll],2)+np.power(NN[ll],2)+np.power(EE[ll],2)))
-        PHTred.append(vett)
+    PHTred=np.sqrt(ZZ**2+NN**2+EE**2)
 
-    PHTred_noise=[]
-    for lll in range(len(ZZ_noise)):
-        vett_noise=sqrt((np.power(ZZ_noise[lll],2)+np.power(NN_noise[lll],2)+np.power(EE_noise[lll],2)))
-        PHTred_noise.append(vett_noise)
+    if cached_noise is None:
+        PHTred_noise=smooth(np.sqrt(ZZ_noise**2+NN_noise**2+EE_noise**2),cfg["SourceSpectra"]["Smoothing"])
+        if noise_cache is not None:
+            noise_cache[noise_key]=(Fred_noise, PHTred_noise)
+    else:
+        Fred_noise, PHTred_noise = cached_noise
     #-----------------------------------------------------------------------------#
 
-    #Smoothing
-    PHTred=smooth(np.array(PHTred),cfg["SourceSpectra"]["Smoothing"])
-    PHTred_noise=smooth(np.array(PHTred_noise),cfg["SourceSpectra"]["Smoothing"])
+    return BuildSpectra(cfg, id, st, sta, phase, [Pick-i, Pick+j], NoiseWindTimes, Fred, PHTred, Fred_noise, PHTred_noise)
+
+
+
+def BuildSpectra(cfg, id, st, sta, phase, SigWindTimes, NoiseWindTimes, Fred, PHTred, Fred_noise, PHTred_noise):
+    """
+    Smooth the combined amplitude spectra, compute the SNR and store the results in a Spectra object.
+
+    Parameters:
+        cfg (dict): Configuration settings.
+        id (str): Identifier of the signal window.
+        st (Stream): Seismic data stream.
+        sta (str): Station identifier.
+        phase (str): Seismic phase ('P' or 'S').
+        SigWindTimes (list): Start and end time of the signal window.
+        NoiseWindTimes (list): Start and end time of the noise window.
+        Fred (numpy.ndarray): Frequencies of the signal spectrum.
+        PHTred (numpy.ndarray): Signal spectrum combined over the three components.
+        Fred_noise (numpy.ndarray): Frequencies of the noise spectrum.
+        PHTred_noise (numpy.ndarray): Smoothed noise spectrum combined over the three components.
+
+    Returns:
+        Spectra: Spectra object of the signal window.
+    """
+
+    #Smoothing (the noise spectrum is smoothed by the caller, so that it can be cached)
+    PHTred=smooth(np.asarray(PHTred),cfg["SourceSpectra"]["Smoothing"])
     #-----------------------------------------------------------------------------#
 
 
     #Calculus of the SNR
-    goodFreq=[]
-    freqExpl=[]
-    countFreq=0
-        
-    for jk in np.arange(0,len(Fred),1):
-        if Fred[jk] <= cfg["SourceSpectra"]["SnrFmax"]:
-            freqExpl.append(PHTred[jk])
-            if (PHTred[jk]/PHTred_noise[jk]) >= cfg["SourceSpectra"]["SnrThr"]:
-                countFreq += 1
-                goodFreq.append(PHTred[jk]) 
+    freqExpl=np.nonzero(Fred <= cfg["SourceSpectra"]["SnrFmax"])[0]
+    countFreq=int(np.sum((PHTred[freqExpl]/PHTred_noise[freqExpl]) >= cfg["SourceSpectra"]["SnrThr"]))
 
     PercSnr=(countFreq/len(freqExpl))*100
     #-----------------------------------------------------------------------------#
@@ -178,15 +239,10 @@ def SpectraProcessing(cfg, id, st, i, j, sta, phase):
     #-----------------------------------------------------------------------------#
 
     #Store the results in the Class Spectra
-    Ppick=P 
-    Spick=S
+    Ppick=st[0].stats.sac.a
+    Spick=st[0].stats.sac.t0
     #station=st[0].stats.station
     station=sta
-    SigWindTimes=[Pick-i, Pick+j]
-    if phase=="P":
-        NoiseWindTimes=[P-i-win_dur, P-i]
-    else:
-        NoiseWindTimes=[P-win_dur, P]
     SigFrequencies=Fred
     SigSpectrum=PHTred
     NoiseFrequencies=Fred_noise 
@@ -201,3 +257,311 @@ def SpectraProcessing(cfg, id, st, i, j, sta, phase):
                 SigFrequencies,SigSpectrum,NoiseFrequencies,NoiseSpectrum,PercSnr,CurveFit,CalculatedSpectrum,CostFunction)
 
     return spectra
+
+
+
+def NoiseCacheKey(cfg, st, NoiseWindTimes, win_dur):
+    """
+    Key of a noise spectrum in the noise cache of a station.
+
+    The noise spectrum depends only on the samples of the noise window and on the zero
+    padding (which depends on the window duration). The three components share the same
+    sample range, so one key covers the combined Z/N/E spectrum.
+
+    Parameters:
+        cfg (dict): Configuration settings.
+        st (Stream): Seismic data stream.
+        NoiseWindTimes (list): Start and end time of the noise window.
+        win_dur (float): Duration of the signal window.
+
+    Returns:
+        tuple: (first sample, last sample, padding samples) of the noise window.
+    """
+    sampRate = st[0].stats.sampling_rate
+    delta = st[0].stats.delta
+    pad_len_pts = int(((cfg["SourceSpectra"]["Padding"] - win_dur) / 2) / delta)
+
+    return (int(NoiseWindTimes[0] * sampRate), int(NoiseWindTimes[1] * sampRate), pad_len_pts)
+
+
+
+def WelchNoisePSD(cfg, st):
+    """
+    Noise power spectral density of each component of a station, estimated once from the
+    whole pre-event segment (from the beginning of the trace to the P pick) with Welch
+    averaging of linearly detrended, Hann-windowed segments overlapping by 50%.
+
+    Parameters:
+        cfg (dict): Configuration settings.
+        st (Stream): Seismic data stream.
+
+    Returns:
+        tuple: Frequencies, one-sided PSD of the Z/N/E components (3 x frequencies) and
+            start and end time of the pre-event segment, or None if the pre-event segment is
+            shorter than one Welch segment (e.g. P pick at the beginning of the trace).
+    """
+    sampRate = st[0].stats.sampling_rate
+    P = st[0].stats.sac.a
+    stop = int(P * sampRate)
+
+    # Segments as long as the longest signal window, unless set by SourceSpectra.WelchSegment
+    seg = cfg["SourceSpectra"].get("WelchSegment", cfg["WaveformProcessing"]["MinLength"] + 2 * cfg["WaveformProcessing"]["MaxLength"])
+    nperseg = max(2, int(seg * sampRate))
+
+    if stop < nperseg:
+        warnings.warn("The pre-event segment of station %s (%.2f s) is shorter than a Welch segment (%.2f s): "
+                      "the noise windows are used instead of the Welch noise model." % (st[0].stats.station, stop / sampRate, nperseg / sampRate))
+        return None
+
+    f, Pxx = welch(np.vstack([st[c].data[:stop] for c in [0, 1, 2]]), fs=sampRate, nperseg=nperseg, detrend='linear', axis=-1)
+
+    return f, Pxx, [0., stop / sampRate]
+
+
+def WelchNoiseSpectrum(cfg, st, noise_key, noise_cache=None):
+    """
+    Noise spectrum of a noise window from the Welch noise model of the station (see WelchNoisePSD).
+
+    The PSD is interpolated on the frequencies of the window spectrum and scaled to the
+    root-mean-square amplitude spectrum that a noise window with the samples and padding of
+    noise_key would have after the same processing as the signal (5% Hann taper, 2/N scaling
+    and division by 2*pi*f); the three components are combined as for the signal. The PSD
+    and the spectra of each window length are stored in noise_cache, if given.
+
+    Parameters:
+        cfg (dict): Configuration settings.
+        st (Stream): Seismic data stream.
+        noise_key (tuple): (first sample, last sample, padding samples) of the noise window (see NoiseCacheKey).
+        noise_cache (dict): Optional cache of the noise spectra of the station.
+
+    Returns:
+        tuple: Frequencies and noise spectrum combined over the three components, and start
+            and end time of the pre-event segment, or None if the station has no Welch noise
+            model (see WelchNoisePSD): the noise window is then used.
+    """
+    start, stop, pad_len_pts = noise_key
+    n = stop - start
+    N = n + 2 * pad_len_pts
+
+    if noise_cache is not None and ('welch', n, N) in noise_cache:
+        return noise_cache[('welch', n, N)]
+
+    if noise_cache is not None and 'welch' in noise_cache:
+        psd = noise_cache['welch']
+    else:
+        psd = WelchNoisePSD(cfg, st)
+        if noise_cache is not None:
+            noise_cache['welch'] = psd
+    if psd is None:
+        return None
+    f, Pxx, NoiseWindTimes = psd
+
+    sampRate = st[0].stats.sampling_rate
+    Fred_noise = np.fft.rfftfreq(N, st[0].stats.delta)[1:int(N / 2 - 1)]
+    power = sum(np.interp(Fred_noise, f, Pxx[c]) for c in [0, 1, 2])
+    PHTred_noise = np.sqrt(power * sampRate * np.sum(_HannTaper(n)**2) / 2) * (2. / N) / (2 * np.pi * Fred_noise)
+
+    noise = (Fred_noise, PHTred_noise, NoiseWindTimes)
+    if noise_cache is not None:
+        noise_cache[('welch', n, N)] = noise
+
+    return noise
+
+
+@lru_cache(maxsize=None)
+def _HannTaper(npts):
+    """
+    Hann taper of 5% per side, as applied by obspy Trace.taper(type='hann', max_percentage=0.05).
+    """
+    wlen = min(int(0.05 * npts), int(npts / 2))
+    if 2 * wlen == npts:
+        taper_sides = hann(2 * wlen)
+    else:
+        taper_sides = hann(2 * wlen + 1)
+
+    return np.hstack((taper_sides[:wlen], np.ones(npts - 2 * wlen), taper_sides[len(taper_sides) - wlen:]))
+
+
+
+@lru_cache(maxsize=8)
+def _TwiddleTable(N):
+    """
+    Cosine and sine of the N roots of unity of an N-point transform.
+    """
+    ang = 2 * np.pi * np.arange(N) / N
+    return np.cos(ang), np.sin(ang)
+
+
+def _DFTBasis(n, N, K):
+    """
+    Real DFT basis (cosine and sine columns) of the bins 1 to K-1 of an N-point transform of n samples.
+
+    Each basis is an n x 2(K-1) matrix and there is one per window length, so the cache is bounded
+    by size (DFT_BASIS_CACHE_BYTES) rather than by number of entries: the least recently used bases
+    are dropped first, and a basis larger than the bound is not cached.
+    """
+    key = (n, N, K)
+    with _dft_bases_lock:
+        if key in _dft_bases:
+            _dft_bases.move_to_end(key)
+            return _dft_bases[key]
+
+    cos, sin = _TwiddleTable(N)
+    idx = np.outer(np.arange(n), np.arange(1, K)) % N
+    basis = np.hstack([cos[idx], sin[idx]])
+
+    if basis.nbytes <= DFT_BASIS_CACHE_BYTES:
+        with _dft_bases_lock:
+            if key not in _dft_bases:
+                _dft_bases[key] = basis
+                _dft_bases_bytes[0] += basis.nbytes
+            while _dft_bases_bytes[0] > DFT_BASIS_CACHE_BYTES:
+                _, old = _dft_bases.popitem(last=False)
+                _dft_bases_bytes[0] -= old.nbytes
+
+    return basis
+
+
+def AmplitudeSpectra(T, starts, stops, pad_len_pts, delta, fmax=None, margin=0):
+    """
+    Compute the displacement amplitude spectra of several segments of a trace.
+
+    Segments with the same number of samples and padding are stacked in a 2-D array,
+    detrended and tapered together and transformed with a single rfft call. Each segment
+    gets the same processing as a single window in SpectraProcessing (demean, linear
+    detrend, 5% Hann taper, zero padding, 2/N scaling and division by 2*pi*f). The zero
+    padding is appended at the end of the segments: a circular shift does not change the
+    amplitude spectrum.
+
+    If fmax is given, the spectra are computed only up to fmax plus margin bins. The bins
+    are then evaluated with a precomputed DFT basis (one matrix product for all the
+    segments of a group) when this is cheaper than the full FFT.
+
+    Parameters:
+        T (numpy.ndarray): Trace samples.
+        starts (numpy.ndarray): First sample of each segment.
+        stops (numpy.ndarray): Last sample (excluded) of each segment.
+        pad_len_pts (numpy.ndarray): Number of zeros padded on each side of each segment.
+        delta (float): Sampling interval.
+        fmax (float, optional): Highest frequency needed (default: all the frequencies).
+        margin (int, optional): Number of bins computed beyond fmax (e.g. for the smoothing).
+
+    Returns:
+        list: (frequencies, amplitude spectrum) of each segment, in input order.
+    """
+    stops = np.minimum(stops, len(T))
+    npts = stops - starts
+    nfft = npts + 2 * pad_len_pts
+
+    spectra = [None] * len(starts)
+    groups = {}
+    for k, key in enumerate(zip(npts, nfft)):
+        groups.setdefault(key, []).append(k)
+
+    for (n, N), rows in groups.items():
+        K = int(N / 2 - 1)
+        if fmax is not None:
+            K = max(2, min(K, int(fmax * N * delta) + 2 + margin))
+        F = np.fft.rfftfreq(N, delta)
+        Fred = F[1:K]
+        taper = _HannTaper(n)
+        use_basis = K < int(N / 2 - 1) and 2 * n * K < 10 * N * np.log2(N)
+
+        for b in range(0, len(rows), BATCH_ROWS):
+            block = np.array(rows[b:b + BATCH_ROWS])
+            X = T[starts[block, None] + np.arange(n)]
+            X = detrend(X, axis=1, type='constant')
+            X = detrend(X, axis=1, type='linear')
+            X *= taper
+            if use_basis:
+                Y = X @ _DFTBasis(n, N, K)
+                PHT = np.hypot(Y[:, :K - 1], Y[:, K - 1:]) * (2. / N)
+            else:
+                PHT = np.abs(np.fft.rfft(X, n=N, axis=1)[:, 1:K]) * (2. / N)
+            PHTred = PHT / (2 * np.pi * Fred)
+            for k, row in zip(block, PHTred):
+                spectra[k] = (Fred, row)
+
+    return spectra
+
+
+
+def SpectraProcessingBatch(cfg, windows, st, sta, phase, noise_cache=None):
+    """
+    Perform Spectra Processing on all the signal windows of a station at once.
+
+    Parameters:
+        cfg (dict): Configuration settings.
+        windows (list): List of (id, i, j) signal windows.
+        st (Stream): Seismic data stream.
+        sta (str): Station identifier.
+        phase (str): Seismic phase ('P' or 'S').
+        noise_cache (dict): Optional cache of the smoothed noise spectra of the station (see NoiseCacheKey).
+
+    Returns:
+        list: Spectra objects, in the same order as windows.
+
+    Notes:
+        - The spectra are the same as those of SpectraProcessing, but every component is
+          processed as a 2-D array of windows (see AmplitudeSpectra).
+    """
+
+    P = st[0].stats.sac.a
+    S = st[0].stats.sac.t0
+    Pick = P if phase == 'P' else S
+
+    sampRate = st[0].stats.sampling_rate
+    delta = st[0].stats.delta
+    tot_len = cfg["SourceSpectra"]["Padding"]
+
+    i = np.array([w[1] for w in windows], dtype=float)
+    j = np.array([w[2] for w in windows], dtype=float)
+
+    # --- Signal and Noise Windows --- #
+    win_dur = ((Pick + j)) - ((Pick - i))
+    pad_len_pts = np.array([int(((tot_len - d) / 2) / delta) for d in win_dur])
+    sig_starts = np.array([int(t * sampRate) for t in Pick - i])
+    sig_stops = np.array([int(t * sampRate) for t in Pick + j])
+    if phase == "P":
+        noise_t1, noise_t2 = P - i - win_dur, P - i
+    else:
+        noise_t1, noise_t2 = P - win_dur, np.full(len(windows), P)
+    noise_keys = [NoiseCacheKey(cfg, st, [t1, t2], d) for t1, t2, d in zip(noise_t1, noise_t2, win_dur)]
+
+    # --- Band of the Spectra (only the frequencies used by the SNR and the fit) --- #
+    if cfg["SourceSpectra"].get("BandLimitedDFT", False):
+        fmax = max(cfg["SourceSpectra"]["Fmax"], cfg["SourceSpectra"]["SnrFmax"])
+        margin = cfg["SourceSpectra"]["Smoothing"]
+    else:
+        fmax, margin = None, 0
+
+    # --- Signal Spectra --- #
+    sig = [AmplitudeSpectra(st[c].data, sig_starts, sig_stops, pad_len_pts, delta, fmax, margin) for c in [0, 1, 2]]
+
+    # --- Noise Spectra (only the noise windows not in the cache, once each) --- #
+    if noise_cache is None:
+        noise_cache = {}
+    if cfg["SourceSpectra"].get("NoiseModel", "window") == "welch" and noise_keys and WelchNoiseSpectrum(cfg, st, noise_keys[0], noise_cache) is not None:
+        for key in set(noise_keys):
+            Fred_noise, PHTred_noise, NoiseWindTimes = WelchNoiseSpectrum(cfg, st, key, noise_cache)
+            noise_cache[key] = (Fred_noise, PHTred_noise)
+        noise_t1 = np.full(len(windows), NoiseWindTimes[0])
+        noise_t2 = np.full(len(windows), NoiseWindTimes[1])
+    missing = sorted(set(noise_keys) - set(noise_cache))
+    if missing:
+        keys = np.array(missing)
+        noise = [AmplitudeSpectra(st[c].data, keys[:, 0], keys[:, 1], keys[:, 2], delta, fmax, margin) for c in [0, 1, 2]]
+        for k, key in enumerate(missing):
+            PHTred_noise = np.sqrt(noise[0][k][1]**2 + noise[1][k][1]**2 + noise[2][k][1]**2)
+            noise_cache[key] = (noise[0][k][0], smooth(PHTred_noise, cfg["SourceSpectra"]["Smoothing"]))
+
+    SpectraList = []
+    for k, (id, _, _) in enumerate(windows):
+        Fred = sig[0][k][0]
+        PHTred = np.sqrt(sig[0][k][1]**2 + sig[1][k][1]**2 + sig[2][k][1]**2)
+        Fred_noise, PHTred_noise = noise_cache[noise_keys[k]]
+
+        SpectraList.append(BuildSpectra(cfg, id, st, sta, phase, [Pick - i[k], Pick + j[k]], [noise_t1[k], noise_t2[k]],
+                                        Fred, PHTred, Fred_noise, PHTred_noise))
+
+    return SpectraList
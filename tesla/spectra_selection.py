@@ -21,23 +21,23 @@ import os
 import shutil
 
 
-def SpectraSelection(SpectraList,cfg,phase,show_table=False):
+def RankSpectra(SpectraList,cfg,phase):
     """
-    Perform Spectra Selection based on specified criteria.
+    Rank a list of fitted spectra with the criteria of the Spectra Selection.
 
     Parameters:
         SpectraList (list): List of Spectra objects.
         cfg (dict): Configuration settings.
         phase (str): Seismic phase ('P' or 'S').
-        show_table (bool): Whether to show the selection summary table.
 
     Returns:
-        Spectra_sel (dict): Dictionary of selected Spectra objects.
-        Spectra_not_sel (dict): Dictionary of rejected Spectra objects.
+        df_sel (DataFrame): Selected spectra.
+        df_all (DataFrame): All the spectra that passed the quality and SNR checks, sorted by
+            Cost Function (or by normalized RMS if CostFunctionClass is False).
 
     Notes:
-        - This function performs Spectra Selection on a list of Spectra objects based on specified criteria in the configuration file.
-        - Selected and rejected Spectra objects are returned as separate dictionaries.
+        - This function does not modify the Spectra objects and does not write any file, so it can
+          also be used to rank partial sets of windows (see the adaptive window search).
     """
 
 
@@ -165,6 +165,10 @@ def SpectraSelection(SpectraList,cfg,phase,show_table=False):
             omega0_err_max=df_snr['Omega0_Error'].max()
             corn_frq_err_max=df_snr['Corner_Frequency_Error'].max()
             q_val_err_max=df_snr['Q_Error'].max()
+
+            #---With a fixed Q (station-constrained attenuation) the Q errors are all 0---#
+            if q_val_err_max==0:
+                q_val_err_max=1.0
             df_snr.eval("Cost_Function=(((RMS_CurveFit/@rms_fit_max)*1)+((Omega0_Error/@omega0_err_max)*1)+((Corner_Frequency_Error/@corn_frq_err_max)*1)+((Q_Error/@q_val_err_max)*1))/4",inplace=True)
 
             #---Sort the results in a ascending order according to Cost Function and RMS normalized values---#
@@ -223,6 +227,82 @@ def SpectraSelection(SpectraList,cfg,phase,show_table=False):
 
             df_sel=df_sel_.loc[(df_sel_['RMS_Normalized'] <= q1)]
 
+    return df_sel, df_all
+
+
+
+def RankingTerms(Spectra,cfg,phase):
+    """
+    Return the values that rank a fitted spectrum in RankSpectra, without building a DataFrame.
+
+    Parameters:
+        Spectra (Spectra): Fitted Spectra object.
+        cfg (dict): Configuration settings.
+        phase (str): Seismic phase ('P' or 'S').
+
+    Returns:
+        tuple: The terms of the Cost Function (RMS_CurveFit, Omega0_Error, Corner_Frequency_Error,
+            Q_Error), or an empty tuple if CostFunctionClass is False, and the normalized RMS.
+            None if the spectrum does not pass the quality and SNR checks of RankSpectra.
+
+    Notes:
+        - RankSpectra sorts the spectra by the Cost Function, i.e. the mean of the terms divided by
+          their maxima, and then by the normalized RMS. A spectrum whose terms and normalized RMS
+          are all lower than or equal to those of another one is therefore never ranked after it.
+    """
+
+    Pick=Spectra.Ppick if phase=='P' else Spectra.Spick
+    fit=Spectra.CurveFit
+
+    after=float(Spectra.SigWindTimes[1]-Pick)
+    fc=float(fit['Fc'])
+    frq_pre_fc=cfg["CurveFitting"]["PreFc"] * (1/cfg["SourceSpectra"]["Padding"])
+
+    if not (after > 0 and fc > frq_pre_fc + (1/after) and Spectra.SnrPerc >= cfg["SourceSpectra"]["SnrPerc"]):
+        return None
+
+    rms_norm=float(fit['Rms2'])
+
+    if not cfg["SpectraSelection"]["CostFunctionClass"]:
+        return (), rms_norm
+
+    values=[float(Spectra.SigWindTimes[1]-Spectra.SigWindTimes[0]),float(Pick-Spectra.SigWindTimes[0]),after,
+        float(fit['Omega0']),float(fit['Omega0Err']),fc,float(fit['FcErr']),float(fit['Q']),float(fit['QErr']),
+        float(fit['DeltaOmega']),float(fit['Rms1']),rms_norm]
+
+    if not (np.all(np.isfinite(values)) and fc > cfg["SourceSpectra"]["Fmin"] and fc < cfg["SourceSpectra"]["Fmax"]
+            and float(fit['Q']) > 0 and float(fit['Q']) < 1500 and float(fit['DeltaOmega']) > cfg["SpectraSelection"]["DeltaOmegaThr"]):
+        return None
+
+    return (float(fit['Rms1']),float(fit['Omega0Err']),float(fit['FcErr']),float(fit['QErr'])), rms_norm
+
+
+
+def SpectraSelection(SpectraList,cfg,phase,show_table=False):
+    """
+    Perform Spectra Selection based on specified criteria.
+
+    Parameters:
+        SpectraList (list): List of Spectra objects.
+        cfg (dict): Configuration settings.
+        phase (str): Seismic phase ('P' or 'S').
+        show_table (bool): Whether to show the selection summary table.
+
+    Returns:
+        Spectra_sel (dict): Dictionary of selected Spectra objects.
+        Spectra_not_sel (dict): Dictionary of rejected Spectra objects.
+
+    Notes:
+        - This function performs Spectra Selection on a list of Spectra objects based on specified criteria in the configuration file.
+        - Selected and rejected Spectra objects are returned as separate dictionaries.
+    """
+
+    df_sel, df_all = RankSpectra(SpectraList,cfg,phase)
+
+    sta=str(SpectraList[0].station)
+    numb=[int(str(Spectra.id).split('.')[0]) for Spectra in SpectraList]
+    id=[str(Spectra.id) for Spectra in SpectraList]
+
 
 
 
@@ -10,70 +10,824 @@ EUPL © the European Union 2007, 2016
 Copyright (C) 2023 Guido Maria Adinolfi, University of Turin, Turin, Italy. For inquiries, contact: guidomaria.adinolfi@unito.it
 
 Dependencies:
-- glob
+- fnmatch
+- functools
+- heapq
+- itertools
 - numpy
 - obspy
+- pickle
 - rich
+- scipy
 - shutil
+- tempfile
 - tesla.spectra_processing 
 - tesla.curve_fitting 
+- tesla.event_archive
 - tesla.plot_spectra 
 - tesla.save_object 
 - tesla.load_object 
 - tesla.spectra_selection 
 """
-import glob
-from obspy import read
-from tesla.spectra_processing import SpectraProcessing
-from tesla.curve_fitting import SpectraFitting
+import heapq
+import os
+import warnings
+from fnmatch import fnmatch
+from functools import lru_cache
+from obspy import read, Stream
+from tesla.spectra_processing import SpectraProcessing, SpectraProcessingBatch, BATCH_ROWS
+from tesla.curve_fitting import SpectraFitting, SkipFitting, BatchSpectraFitting, RestoreFit, BATCH_ENGINE
+from tesla.event_archive import OpenArchive, ArchiveFiles, ArchiveStream
 from tesla.plot_spectra import PlotSpectraLoop
 from tesla.save_object import SaveObject
 from tesla.load_object import LoadObject
-from tesla.spectra_selection import SpectraSelection
+from tesla.spectra_selection import SpectraSelection, RankSpectra, RankingTerms
 import numpy as np
+import pickle
+from itertools import count, islice
+from scipy.signal import decimate, detrend, iirfilter, sosfilt
 import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from rich.console import Console
 from rich.theme import Theme
 
 
+#Waveforms and settings shared by the windows handled by a worker process
+_window_worker={}
 
+#Keys of the station data sent to the window workers
+_window_payloads=count()
 
-def WaveformProcessing(cfg,sta,phase,console):
+
+def IterFitWindows(cfg,windows,st,sta,phase,noise_cache=None):
 	"""
-	Process the waveform data for a given station and seismic phase.
+	Compute and fit the spectra of a list of signal windows, one window at a time.
 
 	Args:
 	    cfg (dict): Configuration parameters.
+	    windows (list): List of (id, i, j) signal windows.
+	    st (Stream): Processed waveforms of the station.
 	    sta (str): The name of the seismic station.
 	    phase (str): The seismic phase to process (P or S).
-	    console (bool): Flag to print progress messages to the console.
+	    noise_cache (dict, optional): Cache of the noise spectra of the station.
+
+	Yields:
+	    Spectra: Fitted Spectra objects, in the same order as windows.
+	"""
+
+	if cfg["SourceSpectra"].get("BatchSpectra", False):
+		spectra=(a for k in range(0,len(windows),BATCH_ROWS)
+			for a in SpectraProcessingBatch(cfg,windows[k:k+BATCH_ROWS],st,sta,phase,noise_cache))
+	else:
+		spectra=(SpectraProcessing(cfg,id,st,i,j,sta,phase,noise_cache) for id,i,j in windows)
+
+	#With the warm start, each window starts from the fit of the previous (neighbouring) window
+	warm_start=cfg["CurveFitting"].get("WarmStart", False)
+	p0=None
+
+	#With the SNR pre-filter, the windows that SpectraSelection would reject for their SNR are not fitted
+	snr_prefilter=cfg["SourceSpectra"].get("SnrPreFilter", False)
+
+	#With the batched engine, BATCH_ROWS spectra at a time are fitted together (no warm start)
+	if cfg["CurveFitting"].get("Engine", "de+lm")==BATCH_ENGINE:
+		while True:
+			chunk=list(islice(spectra,BATCH_ROWS))
+			if not chunk:
+				return
+			skip=[snr_prefilter and a.SnrPerc < cfg["SourceSpectra"]["SnrPerc"] for a in chunk]
+			BatchSpectraFitting(cfg,[a for a,s in zip(chunk,skip) if not s],phase)
+			for a,s in zip(chunk,skip):
+				yield SkipFitting(a) if s else a
+
+	for a in spectra:
+
+		if snr_prefilter and a.SnrPerc < cfg["SourceSpectra"]["SnrPerc"]:
+			yield SkipFitting(a)
+			continue
+
+		b=SpectraFitting(cfg,a,phase,p0)
+
+		if warm_start:
+			p0=(b.CurveFit['Omega0'],b.CurveFit['Fc'],b.CurveFit['Q'])
+
+		yield b
+
+
+def FitWindows(cfg,windows,st,sta,phase,noise_cache=None):
+	"""
+	Compute and fit the spectra of a list of signal windows.
+
+	Args:
+	    cfg (dict): Configuration parameters.
+	    windows (list): List of (id, i, j) signal windows.
+	    st (Stream): Processed waveforms of the station.
+	    sta (str): The name of the seismic station.
+	    phase (str): The seismic phase to process (P or S).
+	    noise_cache (dict, optional): Cache of the noise spectra of the station.
 
 	Returns:
-	    SpectraList (list): List of Spectra objects with fitted parameters and updated data.
-	    Wvfrms (list): List of waveform data objects.
-	    console (bool): Console flag.
+	    SpectraList (list): List of Spectra objects, in the same order as windows.
 	"""
 
+	return list(IterFitWindows(cfg,windows,st,sta,phase,noise_cache))
+
+
+def StripSpectra(spectra):
+	"""
+	Drop the spectral arrays of a Spectra object, keeping the fields used by the Spectra Selection
+	(window times, SNR percentage and CurveFit).
+	"""
+	spectra.SigFrequencies=[]
+	spectra.SigSpectrum=[]
+	spectra.NoiseFrequencies=[]
+	spectra.NoiseSpectrum=[]
+	spectra.CalculatedSpectrum=[]
+
+	return spectra
+
+
+def _RankingKey(ranking,maxima,k):
+	"""
+	Return the sort key of RankSpectra (Cost Function, then normalized RMS) of the ranking values
+	ranking=(terms, rms_norm) of the k-th window (see RankingTerms), with the maxima of the Cost
+	Function terms known so far.
+	"""
+	terms,rms_norm=ranking
+
+	return sum(x/m for x,m in zip(terms,maxima))/4, rms_norm, k
+
+
+def StreamWindows(cfg,windows,st,sta,phase,noise_cache=None):
+	"""
+	Compute and fit the spectra of a list of signal windows with bounded memory.
+
+	The windows are streamed through the processing and the fitting, and only the TopK best windows
+	seen so far keep their spectral arrays, in a heap on the ranking key of RankSpectra. The Cost
+	Function divides its terms by their maxima over all the windows, which are only known at the
+	end: the heap is ranked with the maxima seen so far and reordered when they change. The other
+	windows are reduced to their summary fields (see StripSpectra). The final ranking is computed
+	from the summaries by KeepBestSpectra.
+
+	Returns:
+	    SpectraList (list): List of Spectra objects, in the same order as windows.
+	"""
+
+	top_k=cfg["WaveformProcessing"].get("TopK", 20)
+	rms_thr=cfg["SpectraSelection"]["RmsNormThr"]
+
+	SpectraList=[]
+	rankings={}
+	heap=[]
+	maxima=None
+
+	for k,spectra in enumerate(IterFitWindows(cfg,windows,st,sta,phase,noise_cache)):
+
+		SpectraList.append(spectra)
+
+		ranking=RankingTerms(spectra,cfg,phase)
+		if ranking is None:
+			StripSpectra(spectra)
+			continue
+
+		#---The maxima are taken over all the spectra that pass the checks, as in RankSpectra---#
+		terms=ranking[0]
+		if maxima is None:
+			maxima=list(terms)
+		elif any(x > m for x,m in zip(terms,maxima)):
+			maxima=[max(x,m) for x,m in zip(terms,maxima)]
+			heap=[tuple(-x for x in _RankingKey(rankings[c],[m or 1.0 for m in maxima],c)) for c in rankings]
+			heapq.heapify(heap)
+
+		if not ranking[1] <= rms_thr:
+			StripSpectra(spectra)
+			continue
+
+		rankings[k]=ranking
+		heapq.heappush(heap,tuple(-x for x in _RankingKey(ranking,[m or 1.0 for m in maxima],k)))
+
+		if len(heap) > top_k:
+			c=-heapq.heappop(heap)[2]
+			StripSpectra(SpectraList[c])
+			del rankings[c]
+
+	return SpectraList
+
+
+def KeepBestSpectra(cfg,SpectraList,windows,st,sta,phase,noise_cache=None):
+	"""
+	Keep the spectral arrays of the TopK best spectra and of all the spectra selected by the Spectra
+	Selection only.
+
+	The spectra are ranked by RankSpectra from their summary fields, with the maxima and the quantile
+	of the Cost Function over all the windows. The spectra to keep that were stripped while streaming
+	(see StreamWindows) are computed again and their stored fit is restored, without fitting them.
+
+	Args:
+	    windows (list): The (id, i, j) signal windows of the spectra.
+
+	Returns:
+	    SpectraList (list): List of Spectra objects, in the same order as the input list.
+	"""
+
+	top_k=cfg["WaveformProcessing"].get("TopK", 20)
+	rms_thr=cfg["SpectraSelection"]["RmsNormThr"]
+
+	df_sel, df_all = RankSpectra(SpectraList,cfg,phase)
+	keep=set(df_all.loc[df_all['RMS_Normalized'] <= rms_thr,'No.'][:top_k]) | set(df_sel['No.'])
+
+	restore=[]
+	for k,spectra in enumerate(SpectraList):
+		if int(str(spectra.id).split('.')[0]) not in keep:
+			StripSpectra(spectra)
+		elif not len(spectra.SigSpectrum):
+			restore.append(k)
+
+	#---Compute again the spectra dropped while streaming---#
+	window={w[0]:w for w in windows}
+	restore_windows=[window[SpectraList[k].id] for k in restore]
+	if cfg["SourceSpectra"].get("BatchSpectra", False):
+		spectra=[x for n in range(0,len(restore_windows),BATCH_ROWS)
+			for x in SpectraProcessingBatch(cfg,restore_windows[n:n+BATCH_ROWS],st,sta,phase,noise_cache)]
+	else:
+		spectra=[SpectraProcessing(cfg,id,st,i,j,sta,phase,noise_cache) for id,i,j in restore_windows]
+
+	for k,x in zip(restore,spectra):
+		SpectraList[k]=RestoreFit(cfg,x,SpectraList[k].CurveFit,phase)
+
+	return SpectraList
+
+
+def WindowExecutor(cfg):
+	"""
+	Create the pool of workers for the signal windows selected by WaveformProcessing.Workers
+	and WaveformProcessing.WorkerBackend. The pool is created once per run and shared by all the
+	stations, phases and refinement levels of the window search.
+
+	Args:
+	    cfg (dict): Configuration parameters.
+
+	Returns:
+	    executor (Executor): A ProcessPoolExecutor or a ThreadPoolExecutor, or None if the
+	        windows are fitted serially (Workers not greater than 1 or Streaming enabled).
+	"""
+
+	workers=cfg["WaveformProcessing"].get("Workers", 1)
+
+	if workers <= 1:
+		return None
+
+	if cfg["WaveformProcessing"].get("Streaming", False):
+		warnings.warn("WaveformProcessing.Streaming streams the signal windows serially: Workers (%s) is not used." % (workers))
+		return None
+
+	if cfg["WaveformProcessing"].get("WorkerBackend", "process")=='thread':
+		return ThreadPoolExecutor(max_workers=workers)
+
+	return ProcessPoolExecutor(max_workers=workers)
+
+
+def _FitWindowsTask(task):
+	"""
+	Fit a chunk of signal windows in a worker process. The station data are read from the
+	payload file once per worker process and station, and reused by the following chunks.
+	"""
+	key,path,windows=task
+	w=_window_worker
+
+	if w.get("key")!=key:
+		with open(path,'rb') as f:
+			cfg,st,sta,phase,noise_cache=pickle.load(f)
+		w.update(key=key,cfg=cfg,st=st,sta=sta,phase=phase,noise_cache=noise_cache)
+
+	return FitWindows(w["cfg"],windows,w["st"],w["sta"],w["phase"],w["noise_cache"])
+
+
+def FitWindowsParallel(cfg,windows,st,sta,phase,workers,executor,noise_cache=None):
+	"""
+	Compute and fit the spectra of a list of signal windows on a pool of workers.
+
+	The windows are split into consecutive chunks (a few per worker, to balance the load)
+	and the results are collected in the order of the chunks, so the returned list is in
+	the same window-id order as the serial FitWindows.
+
+	Args:
+	    cfg (dict): Configuration parameters.
+	    windows (list): List of (id, i, j) signal windows.
+	    st (Stream): Processed waveforms of the station.
+	    sta (str): The name of the seismic station.
+	    phase (str): The seismic phase to process (P or S).
+	    workers (int): Number of workers.
+	    executor (Executor): Pool of workers (see WindowExecutor). Threads share the station
+	        data without pickling it (the fitting engine holds no global state); for a process
+	        pool the station data are pickled once to a temporary file, which every worker
+	        reads once, and the tasks only carry the chunks of windows.
+	    noise_cache (dict, optional): Cache of the noise spectra of the station. Threads share
+	        it, while every worker process starts from its own copy.
+
+	Returns:
+	    SpectraList (list): List of Spectra objects, in the same order as windows.
+	"""
+
+	n_chunks=min(len(windows),workers*4)
+	chunks=[[windows[k] for k in chunk] for chunk in np.array_split(np.arange(len(windows)),n_chunks)]
+
+	SpectraList=[]
+
+	if isinstance(executor,ThreadPoolExecutor):
+		for result in executor.map(lambda chunk: FitWindows(cfg,chunk,st,sta,phase,noise_cache),chunks):
+			SpectraList.extend(result)
+	else:
+		key=(os.getpid(),next(_window_payloads))
+		with tempfile.NamedTemporaryFile(prefix='tesla_',suffix='.pkl',delete=False) as f:
+			pickle.dump((cfg,st,sta,phase,noise_cache),f,protocol=pickle.HIGHEST_PROTOCOL)
+		try:
+			for result in executor.map(_FitWindowsTask,[(key,f.name,chunk) for chunk in chunks]):
+				SpectraList.extend(result)
+		finally:
+			os.remove(f.name)
+
+	return SpectraList
+
+
+
+
+def BuildWindowGrid(cfg,phase,P,S,P0,sampRate,delta):
+	"""
+	Build the grid of the signal windows as NumPy arrays.
+
+	The windows are those of the nested loops over i (pre-pick length, from 0 to MaxLength)
+	and j (post-pick length, from MinLength to MinLength+MaxLength) with step WindShift,
+	numbered in the same order. A window is valid if it fits between the picks, is not
+	shorter than MinDurSig and its noise window starts after the beginning of the trace.
+	Because of the rounding of the window times to samples, different grid points can give
+	the same signal and noise samples and padding, hence the same spectra: with
+	WaveformProcessing.Deduplicate only the first of them is kept valid. The windows keep the
+	number of their grid point, so the numbers of the removed windows are missing.
+
+	Args:
+	    cfg (dict): Configuration parameters.
+	    phase (str): The seismic phase to process (P or S).
+	    P (float): P pick.
+	    S (float): S pick.
+	    P0 (float): Earliest start of the S signal windows (not used for the P phase).
+	    sampRate (float): Sampling rate of the waveforms.
+	    delta (float): Sampling interval of the waveforms.
+
+	Returns:
+	    grid (dict): Arrays (one element per grid point) of the window number ('wind_index'),
+	        grid position ('row', 'col'), pre- and post-pick lengths ('i', 'j'), first and last
+	        (excluded) sample of the signal ('sig_start', 'sig_stop') and of the noise window
+	        ('noise_start', 'noise_stop'), padding samples ('pad') and validity mask ('valid'),
+	        plus the grid size ('size') and the number of valid windows that repeat the samples
+	        and padding of a previous one ('duplicates'), removed if Deduplicate is enabled.
+	"""
 
-	#phase=cfg["SourceSpectra"]["Phase"]
-	ext=cfg["Files"]["ext"]
 	min_len=cfg["WaveformProcessing"]["MinLength"]
 	min_dur_sig=cfg["WaveformProcessing"]["MinDurSig"]
 	max_len=cfg["WaveformProcessing"]["MaxLength"]
 	wind_shift=cfg["WaveformProcessing"]["WindShift"]
+	tot_len=cfg["SourceSpectra"]["Padding"]
 
+	ii=np.arange(0, max_len, wind_shift)
+	jj=np.arange(min_len, min_len+max_len, wind_shift)
+	row,col=np.meshgrid(np.arange(len(ii)),np.arange(len(jj)),indexing='ij')
+	row=row.ravel()
+	col=col.ravel()
+	i=ii[row]
+	j=jj[col]
 
+	if phase=='P':
+		Pick=P
+		valid=((P+j) < S) & ((j+i) >= min_dur_sig) & ((P-i-(j+i)) >= 0)
+	else:
+		Pick=S
+		valid=((S-i) > P0) & ((i+j) >= min_dur_sig) & ((P-i-(j+i)) >= 0)
 
+	win_dur=((Pick + j)) - ((Pick - i))
+	if phase=='P':
+		noise_t1,noise_t2=P-i-win_dur,P-i
+	else:
+		noise_t1,noise_t2=P-win_dur,np.full(len(i),P)
+
+	grid={
+		'wind_index': np.arange(1,len(i)+1),
+		'row': row,
+		'col': col,
+		'i': i,
+		'j': j,
+		'sig_start': ((Pick - i) * sampRate).astype(np.int64),
+		'sig_stop': ((Pick + j) * sampRate).astype(np.int64),
+		'noise_start': (noise_t1 * sampRate).astype(np.int64),
+		'noise_stop': (noise_t2 * sampRate).astype(np.int64),
+		'pad': (((tot_len - win_dur) / 2) / delta).astype(np.int64),
+	}
+
+	#Find the valid windows that repeat the samples and the padding (i.e. the FFT length) of a previous valid window
+	ranges=np.column_stack((grid['sig_start'],grid['sig_stop'],grid['noise_start'],grid['noise_stop'],grid['pad']))
+	k_valid=np.nonzero(valid)[0]
+	_,first=np.unique(ranges[k_valid],axis=0,return_index=True)
+	unique=np.zeros(len(i),dtype=bool)
+	unique[k_valid[first]]=True
+
+	grid['duplicates']=int(np.count_nonzero(valid & ~unique))
+	grid['valid']=valid & unique if cfg["WaveformProcessing"].get("Deduplicate", False) else valid
+	grid['size']=len(i)
+
+	return grid
+
+
+def EvaluateWindows(cfg,windows,st,sta,phase,noise_cache=None,executor=None):
+	"""
+	Compute and fit the spectra of a list of signal windows, serially or on the pool
+	selected by WaveformProcessing.Workers and WaveformProcessing.WorkerBackend. With
+	WaveformProcessing.Streaming the windows are streamed serially (see StreamWindows).
 
-	#for sta in cfg["Files"]["stations"]:
+	The pool of the run (see WindowExecutor) is used if given; otherwise a pool is created
+	for this call only.
+
+	Returns:
+	    SpectraList (list): List of Spectra objects, in the same order as windows.
+	"""
+
+	workers=cfg["WaveformProcessing"].get("Workers", 1)
+
+	if cfg["WaveformProcessing"].get("Streaming", False):
+		return StreamWindows(cfg,windows,st,sta,phase,noise_cache)
+
+	if workers > 1 and len(windows) > 1:
+		if executor is not None:
+			return FitWindowsParallel(cfg,windows,st,sta,phase,workers,executor,noise_cache)
+		with WindowExecutor(cfg) as executor:
+			return FitWindowsParallel(cfg,windows,st,sta,phase,workers,executor,noise_cache)
+
+	return FitWindows(cfg,windows,st,sta,phase,noise_cache)
+
+
+def AdaptiveWindowSearch(cfg,windows,lattice,st,sta,phase,noise_cache=None,executor=None):
+	"""
+	Coarse-to-fine search of the signal windows.
+
+	The windows of a coarse grid (one every CoarseShift seconds along both the pre-pick and
+	the post-pick length) are evaluated first and ranked with the same criteria as the
+	Spectra Selection (RankSpectra). Around the RefineTop best windows, the grid step is
+	then halved repeatedly, evaluating only the new windows, until it reaches WindShift.
+	If no window of the coarse grid passes the selection checks, the whole grid is evaluated.
+
+	Args:
+	    cfg (dict): Configuration parameters.
+	    windows (list): List of the valid (id, i, j) signal windows of the full grid.
+	    lattice (list): (row, column) position of each window in the full grid.
+	    st (Stream): Processed waveforms of the station.
+	    sta (str): The name of the seismic station.
+	    phase (str): The seismic phase to process (P or S).
+	    noise_cache (dict, optional): Cache of the noise spectra of the station.
+	    executor (Executor, optional): Pool of workers of the run (see WindowExecutor),
+	        shared by all the refinement levels.
+
+	Returns:
+	    SpectraList (list): List of the evaluated Spectra objects, in window-id order.
+	"""
+
+	wind_shift=cfg["WaveformProcessing"]["WindShift"]
+	step=max(1,int(round(cfg["WaveformProcessing"].get("CoarseShift", 4*wind_shift)/wind_shift)))
+	top=cfg["WaveformProcessing"].get("RefineTop", 3)
+
+	position={key:k for k,key in enumerate(lattice)}
+	number={int(windows[k][0].split('.')[0]):key for key,k in position.items()}
+	evaluated={}
+
+	todo=[key for key in lattice if key[0] % step == 0 and key[1] % step == 0]
+
+	while True:
+
+		todo=sorted(todo, key=lambda key: position[key])
+		for key,spectra in zip(todo,EvaluateWindows(cfg,[windows[position[key]] for key in todo],st,sta,phase,noise_cache,executor)):
+			evaluated[key]=spectra
+
+		if step==1:
+			break
+
+		df_sel,df_all=RankSpectra(list(evaluated.values()),cfg,phase)
+
+		if df_all.empty:
+			todo=[key for key in lattice if key not in evaluated]
+			step=1
+			continue
+
+		best=[number[n] for n in df_all['No.'].tolist()[:top]]
+		new_step=max(1,step//2)
+		todo=set()
+		for a,b in best:
+			for da in range(-2,3):
+				for db in range(-2,3):
+					key=(a+da*new_step,b+db*new_step)
+					if key in position and key not in evaluated:
+						todo.add(key)
+		step=new_step
+
+	return [evaluated[key] for key in sorted(evaluated, key=lambda key: position[key])]
+
+
+def IndexEventDirectory(ext, path='.', names=None):
+	"""
+	Index the waveform files of an event directory by station.
+
+	The directory is listed once; every file '*.STA.*.ext' is registered under each of its
+	inner name tokens, so that the files of a station are found without globbing the
+	directory again.
+
+	Args:
+	    ext (str): Extension of the waveform files.
+	    path (str, optional): Event directory (default: current directory).
+	    names (list, optional): File names to index instead of the content of the directory
+	        (e.g. the files of a packed archive).
+
+	Returns:
+	    index (dict): Dictionary of file name lists, keyed by token.
+	"""
+
+	index={}
+
+	if names is None:
+		names=os.listdir(path)
+
+	for name in sorted(names):
+		tokens=name.split('.')
+		if name.startswith('.') or len(tokens) < 4 or tokens[-1]!=ext:
+			continue
+		for token in set(tokens[1:-2]):
+			index.setdefault(token,[]).append(name)
+
+	return index
+
+
+def StationFiles(index, sta, ext):
+	"""
+	Return the sorted waveform files of a station, i.e. the files matching '*.STA.*.ext'.
+	"""
+	return [name for name in index.get(sta,[]) if fnmatch(name,'*.'+sta+'.*'+'.'+ext)]
+
+
+def TrimStation(cfg,st):
+	"""
+	Trim the waveforms of a station to the span used by the analysis, before preprocessing.
+
+	The span covers the signal and noise windows of the valid grid windows of every phase in
+	SourceSpectra.Phase and the waveform plotted around the picks, extended on both sides by
+	WaveformProcessing.TrimMargin seconds (default: 3/fmin) so that the filter transients fall
+	outside of it. The traces are cut by whole samples (whole seconds, if the sampling rate is
+	an integer, so that the picks are shifted exactly). The reference time of the SAC header
+	(nz* fields) moves with the start of the traces: the time markers (a, o, f, t0-t9) are
+	shifted back by the trimmed duration, while b, the offset of the first sample from the
+	reference time, is unchanged. The picks thus remain offsets from the start of the traces, as TESLA uses them.
+	The traces are left unchanged if there are no picks or no valid windows.
+
+	Args:
+	    cfg (dict): Configuration parameters.
+	    st (Stream): Waveforms of the station, trimmed in place.
+
+	Returns:
+	    st (Stream): Trimmed waveforms of the station.
+	"""
+
+	min_len=cfg["WaveformProcessing"]["MinLength"]
+	max_len=cfg["WaveformProcessing"]["MaxLength"]
+	margin=cfg["WaveformProcessing"].get("TrimMargin", 3./cfg["WaveformProcessing"]["fmin"])
+
+	sampRate=st[0].stats.sampling_rate
+	delta=st[0].stats.delta
+	npts=st[0].stats.npts
+	P=st[0].stats.sac.a
+	S=st[0].stats.sac.t0
+
+	if P==-12345.0:
+		return st
+
+	starts=[]
+	stops=[]
+	for phase in cfg["SourceSpectra"]["Phase"]:
+		if phase=='P':
+			grid=BuildWindowGrid(cfg,phase,P,S if not S==-12345.0 else P+min_len+max_len,None,sampRate,delta)
+		elif not S==-12345.0:
+			grid=BuildWindowGrid(cfg,phase,P,S,P+.3,sampRate,delta)
+		else:
+			continue
+		valid=grid["valid"]
+		if np.any(valid):
+			starts.append(min(grid["sig_start"][valid].min(),grid["noise_start"][valid].min()))
+			stops.append(max(grid["sig_stop"][valid].max(),grid["noise_stop"][valid].max()))
+
+	if not starts:
+		return st
+
+	last=S if not S==-12345.0 else P
+	n0=min(min(starts),int((P-cfg["PlotFigure"]["PreP"])*sampRate))-int(np.ceil(margin*sampRate))
+	n1=max(max(stops),int((last+cfg["PlotFigure"]["PostP"])*sampRate))+int(np.ceil(margin*sampRate))
+
+	step=int(round(sampRate)) if abs(sampRate-round(sampRate)) < 1e-9 and sampRate >= 1 else 1
+	n0=max(0,(n0//step)*step)
+	n1=min(npts,n1)
+
+	if n0==0 and n1==npts:
+		return st
+
+	#Trimmed duration: with an integer sampling rate step is the number of samples per second and
+	#n0 a multiple of it, so n0//step is the trimmed duration in whole seconds
+	shift=n0*delta if step==1 else float(n0//step)
+	for tr in st:
+		tr.data=tr.data[n0:n1]
+		tr.stats.starttime+=shift
+		for key in ['a','o','f']+['t%d' %(k) for k in range(10)]:
+			if key in tr.stats.sac and not tr.stats.sac[key]==-12345.0:
+				tr.stats.sac[key]-=shift
+		if all(key in tr.stats.sac for key in ['b','nzyear','nzjday','nzhour','nzmin','nzsec','nzmsec']):
+			ref=tr.stats.starttime-tr.stats.sac.b
+			tr.stats.sac.update({'nzyear':ref.year,'nzjday':ref.julday,'nzhour':ref.hour,'nzmin':ref.minute,
+				'nzsec':ref.second,'nzmsec':ref.microsecond//1000})
+		if 'e' in tr.stats.sac and 'b' in tr.stats.sac:
+			tr.stats.sac.e=tr.stats.sac.b+(tr.stats.npts-1)*delta
+		if 'npts' in tr.stats.sac:
+			tr.stats.sac.npts=tr.stats.npts
+
+	return st
+
+
+@lru_cache(maxsize=None)
+def BandpassSOS(fs,fmin,fmax,corners):
+	"""
+	Design the Butterworth bandpass filter used to preprocess the waveforms, in second-order
+	sections, as ObsPy does: a highpass filter is designed instead if fmax is at or above the
+	Nyquist frequency. The design is cached, since the sampling rate and the corners rarely change.
+
+	Args:
+	    fs (float): Sampling rate (in Hz).
+	    fmin (float): Low corner frequency (in Hz).
+	    fmax (float): High corner frequency (in Hz).
+	    corners (int): Filter corners (order).
+
+	Returns:
+	    sos (ndarray): Second-order sections of the filter.
+	"""
+
+	fe=0.5*fs
+	low=fmin/fe
+	high=fmax/fe
+
+	if high-1.0 > -1e-6:
+		warnings.warn("Selected high corner frequency (%s) of bandpass is at or above Nyquist (%s). Applying a high-pass instead." %(fmax,fe))
+		if low > 1:
+			raise ValueError("Selected corner frequency is above Nyquist.")
+		return iirfilter(corners,low,btype='highpass',ftype='butter',output='sos')
+
+	if low > 1:
+		raise ValueError("Selected low corner frequency is above Nyquist.")
+
+	return iirfilter(corners,[low,high],btype='band',ftype='butter',output='sos')
+
+
+def PreprocessStream(cfg,st,corners=2):
+	"""
+	Detrend (demean and linear) and zero-phase bandpass filter the components of a station
+	as one 2-D array, with the cached filter design of BandpassSOS. The result matches
+	st.detrend('demean'), st.detrend('linear') and st.filter('bandpass', zerophase=True).
+
+	Components with different sampling rates, lengths or data types are processed trace
+	by trace with ObsPy.
+
+	Args:
+	    cfg (dict): Configuration parameters.
+	    st (Stream): Waveforms of the station, processed in place.
+	    corners (int, optional): Filter corners (default: 2).
+
+	Returns:
+	    st (Stream): Processed waveforms of the station.
+	"""
+
+	fmin=cfg["WaveformProcessing"]["fmin"]
+	fmax=cfg["WaveformProcessing"]["fmax"]
+
+	if (len(set(tr.stats.sampling_rate for tr in st)) != 1 or len(set(tr.stats.npts for tr in st)) != 1
+		or len(set(tr.data.dtype for tr in st)) != 1):
+		st.detrend(type='demean')
+		st.detrend(type='linear')
+		st.filter("bandpass",freqmin=fmin,freqmax=fmax,corners=corners,zerophase=True)
+		return st
+
+	X=np.vstack([tr.data for tr in st])
+	X=detrend(X,axis=-1,type='constant')
+	X=detrend(X,axis=-1,type='linear')
+
+	sos=BandpassSOS(float(st[0].stats.sampling_rate),float(fmin),float(fmax),corners)
+	X=np.flip(sosfilt(sos,np.flip(sosfilt(sos,X,axis=-1),axis=-1),axis=-1),axis=-1)
+
+	for k,tr in enumerate(st):
+		tr.data=np.ascontiguousarray(X[k])
+
+	return st
+
+
+DECIMATE_MARGIN=1.25
+
+
+def DecimationFactor(cfg,sampRate):
+	"""
+	Return the largest integer decimation factor that keeps the analysis band, up to the
+	highest of WaveformProcessing.fmax, SourceSpectra.SnrFmax and SourceSpectra.Fmax, below
+	1/DECIMATE_MARGIN of the Nyquist frequency of the decimated waveforms, where the
+	anti-alias filter of DecimateStream is flat.
+
+	Args:
+	    cfg (dict): Configuration parameters.
+	    sampRate (float): Sampling rate of the waveforms.
+
+	Returns:
+	    factor (int): Decimation factor (1 if the waveforms cannot be decimated).
+	"""
+
+	f_max=max(cfg["WaveformProcessing"]["fmax"],cfg["SourceSpectra"]["SnrFmax"],cfg["SourceSpectra"]["Fmax"])
+
+	return max(1,int(np.floor(sampRate/(2*DECIMATE_MARGIN*f_max))))
+
+
+def DecimateStream(cfg,st):
+	"""
+	Decimate the waveforms of a station by the factor of DecimationFactor, after a zero-phase
+	FIR anti-alias filter (Hamming window, 40 x factor taps). The SAC headers are updated.
+
+	Args:
+	    cfg (dict): Configuration parameters.
+	    st (Stream): Processed waveforms of the station, decimated in place.
+
+	Returns:
+	    factor (int): Decimation factor (1 if the waveforms are left unchanged).
+	"""
+
+	factor=DecimationFactor(cfg,st[0].stats.sampling_rate)
+
+	if factor==1:
+		return factor
+
+	for tr in st:
+		delta=tr.stats.delta*factor
+		tr.data=decimate(tr.data,factor,n=40*factor,ftype='fir',zero_phase=True)
+		tr.stats.delta=delta
+		if 'delta' in tr.stats.sac:
+			tr.stats.sac.delta=delta
+		if 'npts' in tr.stats.sac:
+			tr.stats.sac.npts=tr.stats.npts
+		if 'e' in tr.stats.sac and 'b' in tr.stats.sac:
+			tr.stats.sac.e=tr.stats.sac.b+(tr.stats.npts-1)*delta
+
+	return factor
+
+
+def LoadStation(cfg,sta,console,index=None,archive=None):
+	"""
+	Read and preprocess the waveforms of a station.
+
+	The three components are read once, their lengths are checked, the P (sac.a) and
+	S (sac.t0) picks are copied to all the components and the waveforms are detrended and
+	bandpass filtered. The returned stream can be reused for every phase of the station.
+
+	The waveforms are read from the SAC files of the event directory or, if Files.Layout is
+	'archive', from the packed archive of the event (see tesla.event_archive).
+
+	Args:
+	    cfg (dict): Configuration parameters.
+	    sta (str): The name of the seismic station.
+	    console (bool): Flag to print progress messages to the console.
+	    index (dict, optional): Index of the event files (see IndexEventDirectory).
+	        The current directory, or the archive, is indexed if None.
+	    archive (dict, optional): Packed archive of the event (see OpenArchive). The archive
+	        of the current directory is opened if None and Files.Layout is 'archive'.
+
+	Returns:
+	    st (Stream): Processed waveforms of the station, or None if the station is skipped.
+	"""
+
+	ext=cfg["Files"]["ext"]
+
+	if archive is None and cfg["Files"].get("Layout", "sac")=="archive":
+		archive=OpenArchive()
+
+	if index is None:
+		index=IndexEventDirectory(ext,names=ArchiveFiles(archive) if archive is not None else None)
+
+	files=StationFiles(index,sta,ext)
 
 	#-----------------------------------------------------------------------------#
 	#Check if waveforms of station exist. Otherwise let's skip the station 
-	if len(glob.glob('*.'+sta+'.*'+'.'+ext)) == 0:  
+	if len(files) == 0:  
 		console.log("[warning]WARNING:[/warning]  [normal]No waveforms for station %s" %(sta))
-		return [],[],console
+		return None
 	#-----------------------------------------------------------------------------#
-	st=read('*.'+sta+'.*'+'.'+ext, debug_headers=True)
+	if archive is not None:
+		st=ArchiveStream(archive,files)
+	else:
+		st=Stream()
+		for name in files:
+			st+=read(name, debug_headers=True)
 	#-----------------------------------------------------------------------------#
 	#Check if waveforms have the same no. of points (or the same length). 
 	#Otherwise let's skip the station 
@@ -83,7 +837,7 @@ def WaveformProcessing(cfg,sta,phase,console):
 
 	if any(x != npts_[0] for x in npts_):
 		console.log("[warning]WARNING:[/warning]  [normal]Waforms have different lengths for station %s" %(sta))
-		return [],[],console
+		return None
 	#-----------------------------------------------------------------------------#
 	for k in range(3):
 		if not st[k].stats.sac.a == -12345.0:
@@ -97,6 +851,68 @@ def WaveformProcessing(cfg,sta,phase,console):
 			st[1].stats.sac.t0=st[k].stats.sac.t0
 			st[2].stats.sac.t0=st[k].stats.sac.t0
 			break
+	#-----------------------------------------------------------------------------#
+	if cfg["WaveformProcessing"].get("AutoTrim", False):
+		TrimStation(cfg,st)
+
+	if cfg["WaveformProcessing"].get("BatchPreprocessing", False):
+		PreprocessStream(cfg,st)
+	else:
+		st.detrend(type='demean')
+		st.detrend(type='linear')
+		st.filter("bandpass",freqmin=cfg["WaveformProcessing"]["fmin"],freqmax=cfg["WaveformProcessing"]["fmax"],corners=2,zerophase=True)
+
+	if cfg["WaveformProcessing"].get("Decimate", False):
+		factor=DecimateStream(cfg,st)
+		if factor > 1:
+			console.log("[info]INFO:[/info]     [normal]Waveforms of station %s decimated by %d (%.1f Hz)" %(sta,factor,st[0].stats.sampling_rate))
+
+	return st
+
+
+def WaveformProcessing(cfg,sta,phase,console,noise_cache=None,st=None,executor=None):
+	"""
+	Process the waveform data for a given station and seismic phase.
+
+	Args:
+	    cfg (dict): Configuration parameters.
+	    sta (str): The name of the seismic station.
+	    phase (str): The seismic phase to process (P or S).
+	    console (bool): Flag to print progress messages to the console.
+	    noise_cache (dict, optional): Cache of the noise spectra of the station, shared between
+	        the phases when SourceSpectra.NoiseCache is enabled or SourceSpectra.NoiseModel is
+	        'welch'. A new cache is used if None.
+	    st (Stream, optional): Waveforms of the station already processed by LoadStation,
+	        shared between the phases. The station is loaded if None.
+	    executor (Executor, optional): Pool of workers for the signal windows, created once
+	        per run (see WindowExecutor). A pool is created per call if None and
+	        WaveformProcessing.Workers is greater than 1.
+
+	Returns:
+	    SpectraList (list): List of Spectra objects with fitted parameters and updated data.
+	    Wvfrms (list): List of waveform data objects.
+	    console (bool): Console flag.
+	"""
+
+
+	#phase=cfg["SourceSpectra"]["Phase"]
+	min_len=cfg["WaveformProcessing"]["MinLength"]
+	min_dur_sig=cfg["WaveformProcessing"]["MinDurSig"]
+	max_len=cfg["WaveformProcessing"]["MaxLength"]
+	wind_shift=cfg["WaveformProcessing"]["WindShift"]
+
+
+
+
+	#for sta in cfg["Files"]["stations"]:
+
+	#-----------------------------------------------------------------------------#
+	#Read and preprocess the waveforms, unless they are shared by the caller
+	if st is None:
+		st=LoadStation(cfg,sta,console)
+		if st is None:
+			return [],[],console
+	#-----------------------------------------------------------------------------#
 	#Check if P-pick exists. Otherwise let's skip the station
 	if phase=='P':
 		if st[0].stats.sac.a==-12345.0: #or st[0].stats.sac.t0==-12345.0 :
@@ -110,12 +926,6 @@ def WaveformProcessing(cfg,sta,phase,console):
 			console.log("[warning]WARNING:[/warning]  [normal]There are no S arrival times for station %s" %(sta))
 			return [],[],console
 	#-----------------------------------------------------------------------------#
-	#print(st)
-	st.detrend(type='demean')
-	st.detrend(type='linear')
-	st.filter("bandpass",freqmin=cfg["WaveformProcessing"]["fmin"],freqmax=cfg["WaveformProcessing"]["fmax"],corners=2,zerophase=True)
-
-	#-----------------------------------------------------------------------------#
 
 	if phase=='P':
 		P=st[0].stats.sac.a
@@ -133,67 +943,38 @@ def WaveformProcessing(cfg,sta,phase,console):
 	#min_len=0.2
 	#min_dur_sig=0.2
 
-	wind_index=0
-
-	PSpectra=[]
-	SSpectra=[]
-	SpectraList=[]
-
-	for i in np.arange(0, max_len, wind_shift):
-
-		for j in np.arange(min_len, min_len+max_len, wind_shift):
-
-			wind_index += 1
-			#print('	')
-			#print(P,S,j+i,(P-i-(j+i)))
-			# print(P,P-i,P1)
-			# print(i+j)
-
 	#-----------------------------------------------------------------------------#
+	#Build the grid of the signal windows and keep the valid ones
+	if phase=='P':
+		P0=None
 
-			if phase=='P':
-
-				if not (P+j) < S or (j+i) < min_dur_sig or (P-i-(j+i)) < 0:
-
-					#console.log("[warning]WARNING:[/warning]		[normal]The Signal Window No. %s is oversize!" %(wind_index))
-
-					continue
-
-				else:
-
-					id="%02d.%s.%s" % (wind_index,phase,'Spctr')
-
-					a=SpectraProcessing(cfg,id,st,i,j,sta,phase)
-
-
-					b=SpectraFitting(cfg,a,phase)
+	grid=BuildWindowGrid(cfg,phase,P,S,P0,st[0].stats.sampling_rate,st[0].stats.delta)
 
+	console.log("[info]INFO:[/info]     [normal]Signal window grid: %d windows, %d valid, %d duplicated sample ranges%s"
+		%(grid["size"],np.count_nonzero(grid["valid"]),grid["duplicates"]," removed" if cfg["WaveformProcessing"].get("Deduplicate", False) else ""))
 
-					SpectraList.append(b)
+	windows=[]
+	lattice=[]
+	for k in np.nonzero(grid["valid"])[0]:
+		id="%02d.%s.%s" % (grid["wind_index"][k],phase,'Spctr')
+		windows.append((id,grid["i"][k],grid["j"][k]))
+		lattice.append((int(grid["row"][k]),int(grid["col"][k])))
 
 	#-----------------------------------------------------------------------------#
+	#Compute and fit the spectra of the signal windows
+	if cfg["SourceSpectra"].get("NoiseCache", False) or cfg["SourceSpectra"].get("NoiseModel", "window")=="welch":
+		if noise_cache is None:
+			noise_cache={}
+	else:
+		noise_cache=None
 
+	if cfg["WaveformProcessing"].get("Search", "exhaustive")=="adaptive":
+		SpectraList=AdaptiveWindowSearch(cfg,windows,lattice,st,sta,phase,noise_cache,executor)
+	else:
+		SpectraList=EvaluateWindows(cfg,windows,st,sta,phase,noise_cache,executor)
 
-			if phase=='S':
-
-				if not (S-i) > P0 or (i+j) < min_dur_sig or (P-i-(j+i)) < 0:
-
-					#console.log("[warning]WARNING:[/warning]		[normal]The Signal Window No. %s is oversize!" %(wind_index))
-
-
-					continue
-
-				else:
-					
-					id="%02d.%s.%s" % (wind_index,phase,'Spctr')
-
-					c=SpectraProcessing(cfg,id,st,i,j,sta,phase)
-
-
-					d=SpectraFitting(cfg,c,phase)
-
-
-					SpectraList.append(d)
+	if cfg["WaveformProcessing"].get("Streaming", False) and SpectraList:
+		SpectraList=KeepBestSpectra(cfg,SpectraList,windows,st,sta,phase,noise_cache)
 
 	Wvfrms=st
 
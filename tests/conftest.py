@@ -0,0 +1,92 @@
+"""
+Shared fixtures of the TESLA tests: a configuration and a synthetic event with three stations
+(P and S wavelets on three components, with the SAC picks, depth and distance set).
+"""
+
+import copy
+import numpy as np
+import pytest
+from obspy import Trace, Stream, UTCDateTime
+from obspy.io.sac import SACTrace
+
+
+CONFIG = {
+    "Files": {"stations": ["ST01", "ST02", "ST03"], "ext": "SAC"},
+    "CrustalModel": {"Vp": 5.8, "Vs": 3.4},
+    "WaveformProcessing": {"fmin": 0.5, "fmax": 40, "MinDurSig": 0.5, "MinLength": 0.5, "MaxLength": 1.5, "WindShift": 0.5},
+    "SourceSpectra": {"Phase": ["P", "S"], "SnrThr": 3, "SnrFmax": 20, "SnrPerc": 50, "Fmin": 0.5, "Fmax": 30,
+                      "Padding": 10, "Smoothing": 5},
+    "CurveFitting": {"OmegaBounds": [1.0e-9, 1.0e-4], "FcBounds": [0.5, 40], "QBounds": [10, 1000], "PreFc": 2},
+    "SpectraSelection": {"CostFunctionClass": True, "DeltaOmegaThr": 0.1, "RmsNormThr": 50, "Quant": 0.5},
+    "PlotFigure": {"PreP": 2, "PostP": 10, "FminLim": 0.1, "FmaxLim": 50, "OnlySpectraSel": True,
+                   "ShowFigure": False, "SaveFigure": False},
+    "SaveResult": {"SaveObject": False},
+}
+
+SAMPLING_RATE = 100.0
+NPTS = 6000
+DEPTH = 5.0
+
+
+def StationTraces(sta, dist, seed=0):
+    """
+    Z, N and E traces of a station at the given epicentral distance, with the SAC headers of a picked event.
+    """
+    rng = np.random.default_rng(seed)
+    R = np.hypot(dist, DEPTH)
+    P = 10.0 + R / 5.8
+    S = 10.0 + R / 3.4
+    t = np.arange(NPTS) / SAMPLING_RATE
+
+    traces = []
+    for c, comp in enumerate("ZNE"):
+        x = 1e-7 * rng.standard_normal(NPTS)
+        for pick, amp in [(P, 2e-5 * (1 + c)), (S, 5e-5)]:
+            m = t >= pick
+            tau = t[m] - pick
+            x[m] += amp * np.exp(-tau / 0.6) * np.sin(2 * np.pi * (6 + 2 * c) * tau) * (1 - np.exp(-tau / 0.05))
+        tr = Trace(x.astype(np.float32))
+        tr.stats.sampling_rate = SAMPLING_RATE
+        tr.stats.station = sta
+        tr.stats.channel = "HH" + comp
+        tr.stats.starttime = UTCDateTime(2020, 1, 1)
+        sac = SACTrace.from_obspy_trace(tr)
+        sac.a = P
+        sac.t0 = S
+        sac.evdp = DEPTH
+        sac.dist = dist
+        sac.b = 0.0
+        sac.kcmpnm = comp
+        traces.append(sac)
+
+    return traces
+
+
+@pytest.fixture
+def cfg():
+    """
+    A copy of the test configuration, free to be modified by the test.
+    """
+    return copy.deepcopy(CONFIG)
+
+
+@pytest.fixture
+def stream():
+    """
+    Waveforms of station ST01 as read by TESLA (float data with the SAC headers in stats.sac).
+    """
+    st = Stream([sac.to_obspy_trace() for sac in StationTraces("ST01", 10.0)])
+    for tr in st:
+        tr.data = tr.data.astype(float)
+    return st
+
+
+@pytest.fixture
+def event_dir(tmp_path):
+    """
+    Directory of a synthetic event with the SAC files of the three stations.
+    """
+    for k, sta in enumerate(CONFIG["Files"]["stations"]):
+        for num, sac in enumerate(StationTraces(sta, 10.0 + 8 * k, seed=k), start=1):
+            sac.write(str(tmp_path / ("EV1.%s.%d.%s.SAC" % (sta, num, sac.kcmpnm))))
+    return tmp_path
@@ -0,0 +1,177 @@
+import numpy as np
+import pytest
+from scipy.optimize import curve_fit
+
+from tesla.curve_fitting import BatchLevenbergMarquardt, BatchTableStart, StationQ, PriorRunQ
+from tesla.curve_fitting import DifferentialEvolutionOptions, find_optimal_params, SpectrumFitter, _ModelTable
+from tesla.source_spectrum_function import SourceSpectraTheo
+
+
+BOUNDS = [[1.0e-9, 1.0e-4], [0.5, 40], [10, 1000]]
+TT = 3.0
+
+
+def SyntheticSpectra(n, seed=0, noise=0.1):
+    """
+    Noisy theoretical spectra with random omega, Fc and Q, and random fitting bands.
+    """
+    rng = np.random.default_rng(seed)
+    f = np.linspace(0.5, 30, 300)
+    true = np.column_stack([10 ** rng.uniform(-7, -5, n), rng.uniform(2, 15, n), rng.uniform(50, 500, n)])
+    omg = np.array([SourceSpectraTheo(f, *p, TT) for p in true]) * np.exp(noise * rng.standard_normal((n, len(f))))
+    mask = np.ones(omg.shape, dtype=bool)
+    for k in range(n):
+        mask[k, :rng.integers(0, 20)] = False
+        mask[k, len(f) - rng.integers(0, 60):] = False
+    return f, omg, mask, true
+
+
+def test_batch_lm_matches_curve_fit():
+    f, omg, mask, _ = SyntheticSpectra(12)
+    p0 = BatchTableStart(f, omg, mask, TT, BOUNDS)
+
+    popt, perr, converged = BatchLevenbergMarquardt(f, omg, mask, TT, p0)
+
+    assert converged.all()
+    for k in range(len(omg)):
+        ref, pcov = curve_fit(lambda f1, DC1, fc1, Q: SourceSpectraTheo(f1, DC1, fc1, Q, TT), f[mask[k]], omg[k, mask[k]],
+                              p0=p0[k], maxfev=5000)
+        sse = [np.sum((omg[k, mask[k]] - SourceSpectraTheo(f[mask[k]], *p, TT)) ** 2) for p in (popt[k], ref)]
+        assert sse[0] <= sse[1] * (1 + 1e-6)
+        # Same minimum, within a small fraction of the errors of the parameters
+        np.testing.assert_allclose(perr[k], np.sqrt(np.diag(pcov)), rtol=1e-2)
+        assert np.all(np.abs(popt[k] - ref) < 0.05 * perr[k])
+
+
+def test_batch_lm_recovers_the_parameters():
+    f, omg, mask, true = SyntheticSpectra(20, seed=1, noise=0.01)
+    popt, perr, converged = BatchLevenbergMarquardt(f, omg, mask, TT, BatchTableStart(f, omg, mask, TT, BOUNDS))
+
+    assert converged.all()
+    np.testing.assert_allclose(popt[:, 1], true[:, 1], rtol=0.05)
+    assert np.all(perr > 0)
+
+
+def test_batch_lm_with_a_fixed_q():
+    f, omg, mask, true = SyntheticSpectra(8, seed=2)
+    p0 = BatchTableStart(f, omg, mask, TT, BOUNDS)
+    p0[:, 2] = true[:, 2]
+
+    popt, perr, converged = BatchLevenbergMarquardt(f, omg, mask, TT, p0, fixed_q=True)
+
+    assert converged.all()
+    np.testing.assert_array_equal(popt[:, 2], true[:, 2])
+    np.testing.assert_array_equal(perr[:, 2], 0.)
+    for k in range(len(omg)):
+        ref, _ = curve_fit(lambda f1, DC1, fc1: SourceSpectraTheo(f1, DC1, fc1, true[k, 2], TT), f[mask[k]], omg[k, mask[k]],
+                           p0=p0[k, :2], maxfev=5000)
+        np.testing.assert_allclose(popt[k, :2], ref, rtol=1e-4)
+
+
+@pytest.fixture
+def prior_run(tmp_path):
+    """
+    Event directory of a prior run with the selected spectra of ST01 (P phase, median Q 200).
+    """
+    path = tmp_path / 'P' / 'ST01' / 'sel_spectra'
+    path.mkdir(parents=True)
+    (path / 'Source_Spectra.best.ST01.csv').write_text("No.,Q\n1,100\n2,200\n3,400\n")
+    PriorRunQ.cache_clear()
+    yield str(tmp_path)
+    PriorRunQ.cache_clear()
+
+
+def test_station_q_precedence(cfg, prior_run):
+    fitting = cfg["CurveFitting"]
+    assert StationQ(cfg, 'ST01', 'P', TT) is None
+
+    fitting["FixedQRun"] = prior_run
+    assert StationQ(cfg, 'ST01', 'P', TT) == 200.
+    assert StationQ(cfg, 'ST01', 'S', TT) is None
+    assert StationQ(cfg, 'ST02', 'P', TT) is None
+
+    fitting["FixedTStar"] = {'ST01': 0.02}
+    assert StationQ(cfg, 'ST01', 'P', TT) == pytest.approx(TT / 0.02)
+
+    fitting["FixedQ"] = {'ST01': 300}
+    assert StationQ(cfg, 'ST01', 'P', TT) == 300.
+
+    # Stations missing from a table fall through to the next one
+    fitting["FixedQ"] = {'ST02': 300}
+    assert StationQ(cfg, 'ST01', 'P', TT) == pytest.approx(TT / 0.02)
+
+
+def test_station_q_per_phase(cfg, prior_run):
+    fitting = cfg["CurveFitting"]
+    fitting["FixedQRun"] = [prior_run]
+    fitting["FixedQ"] = {'ST01': {'S': 500}}
+    fitting["FixedTStar"] = {'ST01': {'S': 0.01, 'P': 0.03}}
+
+    assert StationQ(cfg, 'ST01', 'S', TT) == 500.
+    assert StationQ(cfg, 'ST01', 'P', TT) == pytest.approx(TT / 0.03)
+
+    fitting["FixedTStar"] = {'ST01': {'S': 0.01}}
+    assert StationQ(cfg, 'ST01', 'P', TT) == 200.
+
+
+def test_vectorized_differential_evolution_is_opt_in(cfg):
+    assert DifferentialEvolutionOptions(cfg) == {'popsize': 15, 'maxiter': 1000, 'tol': 0.01}
+
+    cfg["CurveFitting"]["Vectorized"] = True
+    options = DifferentialEvolutionOptions(cfg)
+    assert options['vectorized'] and options['updating'] == 'deferred'
+
+    # Both searches reach the minimum of a noiseless spectrum
+    f, omg, _, true = SyntheticSpectra(1, seed=3, noise=0.)
+    for de_options in (None, options):
+        np.testing.assert_allclose(find_optimal_params(BOUNDS, f, omg[0], TT, de_options)[1], true[0, 1], rtol=0.1)
+
+
+def test_table_start_is_the_best_node_of_the_full_grid():
+    f, omg, mask, _ = SyntheticSpectra(6, seed=4)
+    (DCmin, DCmax), (fcmin, fcmax), (Qmin, Qmax) = BOUNDS
+    fc, ts = [a.ravel() for a in np.meshgrid(np.geomspace(fcmin, fcmax, 64), np.geomspace(TT / Qmax, TT / Qmin, 64), indexing='ij')]
+    shapes = -np.pi * f * ts[:, None] - np.log1p((f / fc[:, None]) ** 2)
+
+    for row in omg:
+        y = np.log(row)
+        misfit = np.sum((y - shapes - (y - shapes).mean(axis=1)[:, None]) ** 2, axis=1)
+        k = np.argmin(misfit)
+        DC1, fc1, Q = SpectrumFitter(f, row, TT).table_start(BOUNDS)
+        assert (fc1, TT / Q) == pytest.approx((fc[k], ts[k]), rel=1e-9)
+        assert DC1 == pytest.approx(np.exp((y - shapes[k]).mean()), rel=1e-9)
+
+    np.testing.assert_allclose(BatchTableStart(f, omg, np.ones(omg.shape, dtype=bool), TT, BOUNDS),
+                               [SpectrumFitter(f, row, TT).table_start(BOUNDS) for row in omg], rtol=1e-9)
+
+
+def test_model_table_is_shared_by_the_travel_times():
+    f, omg, mask, _ = SyntheticSpectra(4, seed=5)
+    _ModelTable.cache_clear()
+
+    for tt in np.linspace(1., 8., 20):
+        BatchTableStart(f, omg, mask, tt, BOUNDS)
+        SpectrumFitter(f, omg[0], tt).table_start(BOUNDS)
+        SpectrumFitter(f, omg[0], tt, fixed_q=100.).table_start(BOUNDS)
+
+    info = _ModelTable.cache_info()
+    assert info.misses == info.currsize == 1
+    fc, B = _ModelTable(f.tobytes(), *map(float, BOUNDS[1]), 64)[:2]
+    assert B.shape == (64, len(f))
+
+
+def test_batch_fit_with_a_grid_per_spectrum():
+    f, omg, mask, _ = SyntheticSpectra(6, seed=6)
+    grids = np.array([f * (1. + 0.01 * (k % 3)) for k in range(len(omg))])
+    omg = np.array([row * SourceSpectraTheo(grid, 1., 8., 200., TT) / SourceSpectraTheo(f, 1., 8., 200., TT)
+                    for row, grid in zip(omg, grids)])
+
+    p0 = BatchTableStart(grids, omg, mask, TT, BOUNDS)
+    popt, perr, converged = BatchLevenbergMarquardt(grids, omg, mask, TT, p0)
+
+    assert converged.all()
+    for k, grid in enumerate(grids):
+        np.testing.assert_allclose(p0[k], BatchTableStart(grid, omg[k:k + 1], mask[k:k + 1], TT, BOUNDS)[0], rtol=1e-12)
+        ref = BatchLevenbergMarquardt(grid, omg[k:k + 1], mask[k:k + 1], TT, p0[k:k + 1])
+        np.testing.assert_allclose(popt[k], ref[0][0], rtol=1e-10)
+        np.testing.assert_allclose(perr[k], ref[1][0], rtol=1e-8)
@@ -0,0 +1,91 @@
+import io
+import os
+
+import numpy as np
+from obspy import read
+from rich.console import Console
+
+from tesla.event_archive import PackEvent, OpenArchive, ArchiveFiles, ArchiveStream, ARCHIVE_NAME
+from tesla.waveform_processing import IndexEventDirectory, LoadStation
+from tests.conftest import StationTraces
+
+
+def test_pack_and_read_back(event_dir):
+    filename, ntraces = PackEvent(str(event_dir), 'SAC')
+    names = sorted(name for name in os.listdir(event_dir) if name.endswith('.SAC'))
+
+    assert filename == os.path.join(str(event_dir), ARCHIVE_NAME)
+    assert ntraces == len(names) == 9
+
+    archive = OpenArchive(filename)
+    assert ArchiveFiles(archive) == names
+    assert OpenArchive(filename) is archive
+
+    st = ArchiveStream(archive, names[::-1])
+    assert len(st) == len(names)
+    for tr, name in zip(st, names[::-1]):
+        ref = read(str(event_dir / name), debug_headers=True)[0]
+        assert tr.id == ref.id
+        assert tr.stats.starttime == ref.stats.starttime
+        assert tr.stats.delta == ref.stats.delta
+        np.testing.assert_array_equal(tr.data, ref.data)
+        for key in ('a', 't0', 'b', 'evdp', 'dist', 'kcmpnm'):
+            assert tr.stats.sac[key] == ref.stats.sac[key]
+
+
+def test_stations_load_the_same_from_the_archive(cfg, event_dir, monkeypatch):
+    monkeypatch.chdir(event_dir)
+    PackEvent('.', 'SAC')
+    console = Console(file=io.StringIO())
+    archive = OpenArchive()
+    index = IndexEventDirectory('SAC')
+
+    for sta in cfg["Files"]["stations"]:
+        st = LoadStation(cfg, sta, console, index)
+        packed = LoadStation(cfg, sta, console, IndexEventDirectory('SAC', names=ArchiveFiles(archive)), archive)
+        assert [tr.id for tr in packed] == [tr.id for tr in st]
+        for tr, ref in zip(packed, st):
+            np.testing.assert_array_equal(tr.data, ref.data)
+            assert tr.stats.sac.a == ref.stats.sac.a
+
+    assert LoadStation(cfg, 'ST09', console, index, archive) is None
+
+
+def test_traces_keep_their_data_type(tmp_path):
+    st = read()
+    st[0].data = st[0].data.astype('>f8') / 3.
+    st[1].data = st[1].data.astype(np.int32)
+    st[2].data = st[2].data.astype(np.float32)
+    for num, tr in enumerate(st):
+        tr.write(str(tmp_path / ("EV1.%d.mseed" % num)), format='MSEED')
+
+    filename, ntraces = PackEvent(str(tmp_path), 'mseed')
+    assert ntraces == 3
+    packed = ArchiveStream(OpenArchive(filename), ArchiveFiles(OpenArchive(filename)))
+    for tr, ref in zip(packed, st):
+        assert tr.data.dtype == ref.data.dtype.newbyteorder('<')
+        np.testing.assert_array_equal(tr.data, ref.data)
+
+
+def test_repacked_archive_is_read_again(event_dir):
+    filename, _ = PackEvent(str(event_dir), 'SAC')
+    archive = OpenArchive(filename)
+    old = ArchiveStream(archive, ['EV1.ST01.1.Z.SAC'])[0].data.copy()
+
+    # A longer Z component for ST01, and a new station
+    sac = StationTraces('ST01', 10.0, seed=7)[0]
+    sac.data = np.concatenate([sac.data, sac.data[:100]])
+    sac.write(str(event_dir / 'EV1.ST01.1.Z.SAC'))
+    for num, sac in enumerate(StationTraces('ST04', 40.0, seed=4), start=1):
+        sac.write(str(event_dir / ("EV1.ST04.%d.%s.SAC" % (num, sac.kcmpnm))))
+    PackEvent(str(event_dir), 'SAC')
+
+    repacked = OpenArchive(filename)
+    assert repacked is not archive
+    assert len(ArchiveFiles(repacked)) == 12
+    tr = ArchiveStream(repacked, ['EV1.ST01.1.Z.SAC'])[0]
+    assert tr.stats.npts == len(old) + 100
+    np.testing.assert_array_equal(tr.data, read(str(event_dir / 'EV1.ST01.1.Z.SAC'))[0].data)
+
+    # The stream of the old archive still reads the old samples
+    np.testing.assert_array_equal(ArchiveStream(archive, ['EV1.ST01.1.Z.SAC'])[0].data, old)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from tesla.class_spectra import Spectra
+from tesla.joint_inversion import JointInversion
+from tesla.source_spectrum_function import SourceSpectraTheo
+
+
+FC = 6.0
+
+
+def StationSpectra(seed=0, noise=0.05):
+    """
+    P spectra of five stations with the same corner frequency, and single-station fits biased away from it.
+    """
+    rng = np.random.default_rng(seed)
+    f = np.linspace(0.5, 30, 240)
+    spectra = []
+    for k in range(5):
+        tt, DC1, Q = 2. + k, 10 ** rng.uniform(-7, -5), rng.uniform(100, 600)
+        A = SourceSpectraTheo(f, DC1, FC, Q, tt) * np.exp(noise * rng.standard_normal(len(f)))
+        fit = {'Omega0': DC1 * 1.3, 'Fc': FC * rng.uniform(0.6, 1.5), 'Q': Q * 0.8}
+        spectra.append(('P', 'ST%02d' % (k + 1), Spectra(k + 1, 'ST%02d' % (k + 1), 10., 12., tt, 2 * tt, [9.5, 11.],
+                                                         [8., 9.5], f, A, f, A / 100, 80, fit, None, None)))
+    return spectra
+
+
+def test_joint_inversion_recovers_the_shared_fc(cfg):
+    spectra = StationSpectra()
+
+    df = JointInversion(cfg, spectra)
+
+    assert list(df['Station']) == [sta for phase, sta, spectrum in spectra]
+    assert df['Corner_Frequency'].nunique() == 1
+    assert df['Corner_Frequency'].iloc[0] == pytest.approx(FC, rel=0.03)
+    assert np.all(df['Corner_Frequency_Error'] < 0.3)
+    np.testing.assert_allclose(df['Q'] * df['TStar'], [s.Ptraveltime for phase, sta, s in spectra])
+
+
+def test_joint_inversion_leaves_out_zero_amplitudes(cfg):
+    reference = JointInversion(cfg, StationSpectra())
+
+    spectra = StationSpectra()
+    spectra[0][2].SigSpectrum[::7] = 0.
+    spectra[1][2].SigSpectrum[-20:] = np.nan
+    df = JointInversion(cfg, spectra)
+
+    assert np.all(np.isfinite(df[['Omega0', 'Corner_Frequency', 'TStar', 'RMS_Normalized']]))
+    assert df['Corner_Frequency'].iloc[0] == pytest.approx(reference['Corner_Frequency'].iloc[0], rel=0.01)
+
+
+def test_joint_inversion_drops_spectra_without_amplitudes(cfg):
+    spectra = StationSpectra()
+    spectra[2][2].SigSpectrum[2:] = 0.
+
+    df = JointInversion(cfg, spectra)
+    assert 'ST03' not in list(df['Station'])
+    assert len(df) == 4
+
+    for phase, sta, spectrum in spectra:
+        spectrum.SigSpectrum[:] = 0.
+    with pytest.raises(ValueError):
+        JointInversion(cfg, spectra)
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from tesla import kernels
+from tesla.kernels import GetKernels
+from tesla.source_spectrum_function import SourceSpectraTheo
+
+
+F1 = np.linspace(0.5, 30, 200)
+TT = 3.0
+PARAMS = (2e-6, 6.0, 150.0)
+
+
+def ObservedSpectrum():
+    rng = np.random.default_rng(0)
+    return SourceSpectraTheo(F1, *PARAMS, TT) * np.exp(0.1 * rng.standard_normal(len(F1)))
+
+
+def test_numpy_kernels():
+    k = GetKernels('numpy')
+    omg1 = ObservedSpectrum()
+    x = np.array([np.log(PARAMS[0]), PARAMS[1], PARAMS[2]])
+
+    np.testing.assert_allclose(k['model'](F1, *PARAMS, TT), SourceSpectraTheo(F1, *PARAMS, TT))
+    assert k['sse'](PARAMS, F1, omg1, TT) == pytest.approx(np.sum((omg1 - SourceSpectraTheo(F1, *PARAMS, TT)) ** 2))
+    np.testing.assert_allclose(k['log_residuals'](x, F1, omg1, TT), np.log(SourceSpectraTheo(F1, *PARAMS, TT) / omg1), atol=1e-12)
+
+    # Population of parameter sets
+    population = np.array([PARAMS, (1e-6, 3.0, 80.0)]).T
+    np.testing.assert_allclose(k['sse'](population, F1, omg1, TT), [k['sse'](p, F1, omg1, TT) for p in population.T])
+
+    # Analytic Jacobian against finite differences
+    J = k['log_jacobian'](x, F1, TT)
+    for c in range(3):
+        h = np.zeros(3)
+        h[c] = 1e-6 * max(1., abs(x[c]))
+        fd = (k['log_residuals'](x + h, F1, omg1, TT) - k['log_residuals'](x - h, F1, omg1, TT)) / (2 * h[c])
+        np.testing.assert_allclose(J[:, c], fd, rtol=1e-5, atol=1e-9)
+
+
+def test_numba_kernels_match_numpy():
+    pytest.importorskip("numba")
+    ref, k = GetKernels('numpy'), GetKernels('numba')
+    omg1 = ObservedSpectrum()
+    x = np.array([np.log(PARAMS[0]), PARAMS[1], PARAMS[2]])
+    population = np.array([PARAMS, (1e-6, 3.0, 80.0), (5e-6, 12.0, 600.0)]).T
+
+    assert k is not ref
+    np.testing.assert_allclose(k['model'](F1, *PARAMS, TT), ref['model'](F1, *PARAMS, TT), rtol=1e-12)
+    assert k['sse'](PARAMS, F1, omg1, TT) == pytest.approx(ref['sse'](PARAMS, F1, omg1, TT), rel=1e-12)
+    np.testing.assert_allclose(k['sse'](population, F1, omg1, TT), ref['sse'](population, F1, omg1, TT), rtol=1e-12)
+    np.testing.assert_allclose(k['log_residuals'](x, F1, omg1, TT), ref['log_residuals'](x, F1, omg1, TT), rtol=1e-12, atol=1e-14)
+    np.testing.assert_allclose(k['log_jacobian'](x, F1, TT), ref['log_jacobian'](x, F1, TT), rtol=1e-12)
+
+
+def test_missing_backend_falls_back_to_numpy(monkeypatch):
+    monkeypatch.setattr(kernels, "KERNELS", {'numpy': kernels.KERNELS['numpy']})
+
+    with pytest.warns(UserWarning, match="numba backend is not available"):
+        assert GetKernels('numba') is kernels.KERNELS['numpy']
+    assert GetKernels('auto') is kernels.KERNELS['numpy']
+
+    with pytest.raises(ValueError):
+        GetKernels('cuda')
@@ -0,0 +1,70 @@
+import io
+import tempfile
+
+import pytest
+from rich.console import Console
+
+from tesla.event_archive import PackEvent, ARCHIVE_NAME
+from tesla.main import StationProcessingTask
+from tesla.waveform_processing import IndexEventDirectory, LoadStation, WaveformProcessing, WindowExecutor
+
+
+def SerialResults(cfg, sta):
+    console = Console(file=io.StringIO())
+    st = LoadStation(cfg, sta, console, IndexEventDirectory('SAC'))
+    noise_cache = {}
+    return {phase: WaveformProcessing(cfg, sta, phase, console, noise_cache, st)[0] for phase in cfg["SourceSpectra"]["Phase"]}
+
+
+def AssertSameFits(SpectraList, reference):
+    assert [a.id for a in SpectraList] == [a.id for a in reference]
+    assert reference
+    for a, b in zip(SpectraList, reference):
+        for key in ('Omega0', 'Fc', 'Q', 'Rms2'):
+            assert a.CurveFit[key] == pytest.approx(b.CurveFit[key], rel=1e-9)
+
+
+@pytest.mark.parametrize("layout", ["sac", "archive"])
+def test_station_task_matches_the_serial_run(cfg, event_dir, monkeypatch, layout):
+    monkeypatch.chdir(event_dir)
+    reference = SerialResults(cfg, 'ST02')
+
+    cfg["Files"]["Layout"] = layout
+    archive_file = PackEvent(str(event_dir), 'SAC')[0] if layout == "archive" else None
+    index = IndexEventDirectory('SAC')
+    results = StationProcessingTask(str(event_dir), cfg, 'ST02', {'ST02': index['ST02']}, archive_file)
+
+    for phase in cfg["SourceSpectra"]["Phase"]:
+        AssertSameFits(results[phase][0], reference[phase])
+
+
+def test_station_task_without_waveforms(cfg, event_dir, monkeypatch):
+    monkeypatch.chdir(event_dir)
+
+    results = StationProcessingTask(str(event_dir), cfg, 'ST09', {'ST09': []})
+
+    assert sorted(results) == sorted(cfg["SourceSpectra"]["Phase"])
+    assert all(SpectraList == [] for SpectraList, Wvfrms, records in results.values())
+    assert any('No waveforms for station ST09' in str(record) for record in results['P'][2])
+
+
+@pytest.mark.parametrize("backend", ["thread", "process"])
+def test_window_executor_shared_by_the_phases(cfg, event_dir, monkeypatch, tmp_path, backend):
+    monkeypatch.chdir(event_dir)
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    reference = SerialResults(cfg, 'ST01')
+
+    cfg["WaveformProcessing"].update(Workers=2, WorkerBackend=backend)
+    console = Console(file=io.StringIO())
+    st = LoadStation(cfg, 'ST01', console, IndexEventDirectory('SAC'))
+    executor = WindowExecutor(cfg)
+    try:
+        for phase in cfg["SourceSpectra"]["Phase"]:
+            AssertSameFits(WaveformProcessing(cfg, 'ST01', phase, console, {}, st, executor)[0], reference[phase])
+    finally:
+        executor.shutdown()
+    assert not list(tmp_path.glob("tesla_*.pkl"))
+
+    cfg["WaveformProcessing"]["Streaming"] = True
+    with pytest.warns(UserWarning, match="Streaming"):
+        assert WindowExecutor(cfg) is None
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from tesla import spectra_processing
+from tesla.spectra_processing import SpectraProcessing, SpectraProcessingBatch, AmplitudeSpectra
+
+
+WINDOWS = [(1, 0.0, 0.5), (2, 0.0, 1.0), (3, 0.5, 1.0), (4, 1.0, 1.5), (5, 0.5, 0.5), (6, 0.3, 0.7)]
+
+
+def AssertSameSpectra(a, b):
+    np.testing.assert_allclose(a.SigFrequencies, b.SigFrequencies)
+    np.testing.assert_allclose(a.SigSpectrum, b.SigSpectrum, rtol=1e-9, atol=1e-20)
+    np.testing.assert_allclose(a.NoiseFrequencies, b.NoiseFrequencies)
+    np.testing.assert_allclose(a.NoiseSpectrum, b.NoiseSpectrum, rtol=1e-9, atol=1e-20)
+    np.testing.assert_allclose(a.SigWindTimes, b.SigWindTimes)
+    np.testing.assert_allclose(a.NoiseWindTimes, b.NoiseWindTimes)
+    assert a.SnrPerc == pytest.approx(b.SnrPerc)
+
+
+@pytest.mark.parametrize("phase", ["P", "S"])
+def test_batch_spectra_match_single_windows(cfg, stream, phase):
+    single = [SpectraProcessing(cfg, id, stream, i, j, "ST01", phase) for id, i, j in WINDOWS]
+    batch = SpectraProcessingBatch(cfg, WINDOWS, stream, "ST01", phase)
+
+    assert [a.id for a in batch] == [a.id for a in single]
+    for a, b in zip(single, batch):
+        AssertSameSpectra(a, b)
+
+
+def test_batch_spectra_share_the_noise_cache(cfg, stream):
+    noise_cache = {}
+    single = [SpectraProcessing(cfg, id, stream, i, j, "ST01", "S") for id, i, j in WINDOWS]
+    batch = SpectraProcessingBatch(cfg, WINDOWS, stream, "ST01", "S", noise_cache)
+    again = SpectraProcessingBatch(cfg, WINDOWS, stream, "ST01", "S", noise_cache)
+
+    assert noise_cache
+    for a, b, c in zip(single, batch, again):
+        AssertSameSpectra(a, b)
+        AssertSameSpectra(a, c)
+
+
+def test_band_limited_spectra_match_the_fft(stream):
+    T = stream[0].data
+    starts = np.array([1000, 1050, 1100, 1200])
+    stops = np.array([1100, 1150, 1300, 1300])
+    pad = np.array([450, 450, 400, 450])
+    delta = stream[0].stats.delta
+
+    full = AmplitudeSpectra(T, starts, stops, pad, delta)
+    band = AmplitudeSpectra(T, starts, stops, pad, delta, fmax=30, margin=5)
+
+    for (F, A), (Fb, Ab) in zip(full, band):
+        assert Fb[-1] > 30
+        np.testing.assert_allclose(Fb, F[:len(Fb)])
+        np.testing.assert_allclose(Ab, A[:len(Ab)], rtol=1e-8, atol=1e-12 * A.max())
+
+
+@pytest.mark.parametrize("phase", ["P", "S"])
+def test_band_limited_batch_spectra_match_below_fmax(cfg, stream, phase):
+    full = SpectraProcessingBatch(cfg, WINDOWS, stream, "ST01", phase)
+    cfg["SourceSpectra"]["BandLimitedDFT"] = True
+    band = SpectraProcessingBatch(cfg, WINDOWS, stream, "ST01", phase)
+
+    for a, b in zip(full, band):
+        n = np.count_nonzero(np.asarray(a.SigFrequencies) <= cfg["SourceSpectra"]["Fmax"])
+        np.testing.assert_allclose(b.SigSpectrum[:n], a.SigSpectrum[:n], rtol=1e-8)
+        assert b.SnrPerc == pytest.approx(a.SnrPerc)
+
+
+def test_dft_basis_cache_is_bounded_in_bytes(monkeypatch):
+    monkeypatch.setattr(spectra_processing, "DFT_BASIS_CACHE_BYTES", 3 * 100 * 2 * 19 * 8)
+    monkeypatch.setattr(spectra_processing, "_dft_bases", type(spectra_processing._dft_bases)())
+    monkeypatch.setattr(spectra_processing, "_dft_bases_bytes", [0])
+
+    bases = [spectra_processing._DFTBasis(100, N, 20) for N in (1000, 1024, 1100, 1200)]
+    assert all(b.shape == (100, 38) for b in bases)
+    assert list(spectra_processing._dft_bases) == [(100, N, 20) for N in (1024, 1100, 1200)]
+    assert spectra_processing._dft_bases_bytes[0] <= spectra_processing.DFT_BASIS_CACHE_BYTES
+
+    spectra_processing._DFTBasis(100, 1024, 20)
+    spectra_processing._DFTBasis(100, 1300, 20)
+    assert list(spectra_processing._dft_bases) == [(100, N, 20) for N in (1200, 1024, 1300)]
+
+    large = spectra_processing._DFTBasis(400, 4000, 200)
+    assert large.nbytes > spectra_processing.DFT_BASIS_CACHE_BYTES
+    assert (400, 4000, 200) not in spectra_processing._dft_bases
+
+
+def test_welch_noise_model_matches_between_engines(cfg, stream):
+    cfg["SourceSpectra"]["NoiseModel"] = "welch"
+    single = [SpectraProcessing(cfg, id, stream, i, j, "ST01", "S", {}) for id, i, j in WINDOWS]
+    batch = SpectraProcessingBatch(cfg, WINDOWS, stream, "ST01", "S", {})
+
+    for a, b in zip(single, batch):
+        AssertSameSpectra(a, b)
+        assert a.NoiseWindTimes[0] == 0.
+
+
+@pytest.mark.parametrize("phase", ["P", "S"])
+def test_short_pre_event_segment_falls_back_to_the_noise_windows(cfg, stream, phase):
+    window = SpectraProcessingBatch(cfg, WINDOWS, stream, "ST01", phase)
+    cfg["SourceSpectra"]["NoiseModel"] = "welch"
+    cfg["SourceSpectra"]["WelchSegment"] = 2 * stream[0].stats.sac.a
+
+    with pytest.warns(UserWarning, match="shorter than a Welch segment"):
+        single = [SpectraProcessing(cfg, id, stream, i, j, "ST01", phase, {}) for id, i, j in WINDOWS]
+    with pytest.warns(UserWarning, match="shorter than a Welch segment"):
+        batch = SpectraProcessingBatch(cfg, WINDOWS, stream, "ST01", phase, {})
+
+    for a, b, c in zip(window, single, batch):
+        AssertSameSpectra(a, b)
+        AssertSameSpectra(a, c)
@@ -0,0 +1,160 @@
+import numpy as np
+import pytest
+from obspy import read
+
+from tesla import waveform_processing
+from tesla.class_spectra import Spectra
+from tesla.spectra_selection import RankSpectra
+from tesla.waveform_processing import PreprocessStream, BuildWindowGrid, StreamWindows, KeepBestSpectra, TrimStation
+
+
+def test_preprocess_matches_obspy(cfg, stream):
+    expected = stream.copy()
+    expected.detrend(type='demean')
+    expected.detrend(type='linear')
+    expected.filter("bandpass", freqmin=cfg["WaveformProcessing"]["fmin"], freqmax=cfg["WaveformProcessing"]["fmax"],
+                    corners=2, zerophase=True)
+
+    PreprocessStream(cfg, stream)
+
+    for tr, ref in zip(stream, expected):
+        assert tr.stats.npts == ref.stats.npts
+        np.testing.assert_allclose(tr.data, ref.data, rtol=1e-7, atol=1e-9 * np.abs(ref.data).max())
+
+
+def test_preprocess_falls_back_to_obspy_for_mixed_traces(cfg, stream):
+    stream[2].data = stream[2].data[:-100]
+    expected = stream.copy()
+    expected.detrend(type='demean')
+    expected.detrend(type='linear')
+    expected.filter("bandpass", freqmin=cfg["WaveformProcessing"]["fmin"], freqmax=cfg["WaveformProcessing"]["fmax"],
+                    corners=2, zerophase=True)
+
+    PreprocessStream(cfg, stream)
+
+    for tr, ref in zip(stream, expected):
+        np.testing.assert_array_equal(tr.data, ref.data)
+
+
+def WindowKeys(grid, mask):
+    return np.column_stack([grid[k][mask] for k in ('sig_start', 'sig_stop', 'noise_start', 'noise_stop', 'pad')])
+
+
+@pytest.mark.parametrize("phase", ["P", "S"])
+def test_window_grid_keeps_every_valid_window_by_default(cfg, phase):
+    cfg["WaveformProcessing"]["WindShift"] = 0.004
+    grid = BuildWindowGrid(cfg, phase, 11.18, 13.29, 11.48, 100.0, 0.01)
+
+    assert grid['duplicates'] > 0
+    assert len(grid['valid']) == grid['size'] == len(grid['wind_index'])
+    cfg["WaveformProcessing"]["Deduplicate"] = False
+    np.testing.assert_array_equal(BuildWindowGrid(cfg, phase, 11.18, 13.29, 11.48, 100.0, 0.01)['valid'], grid['valid'])
+
+
+@pytest.mark.parametrize("phase", ["P", "S"])
+def test_window_grid_deduplication(cfg, phase):
+    cfg["WaveformProcessing"]["WindShift"] = 0.004
+    grid = BuildWindowGrid(cfg, phase, 11.18, 13.29, 11.48, 100.0, 0.01)
+    cfg["WaveformProcessing"]["Deduplicate"] = True
+    dedup = BuildWindowGrid(cfg, phase, 11.18, 13.29, 11.48, 100.0, 0.01)
+
+    # Only valid windows are removed, as many as the duplicates reported
+    assert not np.any(dedup['valid'] & ~grid['valid'])
+    assert np.count_nonzero(grid['valid']) - np.count_nonzero(dedup['valid']) == grid['duplicates'] == dedup['duplicates']
+
+    # The kept windows have distinct samples and padding, and cover all the valid ones
+    kept = WindowKeys(dedup, dedup['valid'])
+    assert len(np.unique(kept, axis=0)) == len(kept)
+    assert set(map(tuple, WindowKeys(grid, grid['valid']))) == set(map(tuple, kept))
+
+    # Each kept window is the first (lowest numbered) of its duplicates
+    first = {}
+    for k, key in zip(grid['wind_index'][grid['valid']], map(tuple, WindowKeys(grid, grid['valid']))):
+        first.setdefault(key, k)
+    assert sorted(first.values()) == list(dedup['wind_index'][dedup['valid']])
+
+
+def test_window_grid_keys_duplicates_on_the_padding(cfg):
+    cfg["WaveformProcessing"]["WindShift"] = 0.004
+    cfg["WaveformProcessing"]["Deduplicate"] = True
+    grid = BuildWindowGrid(cfg, 'P', 11.18, 13.29, None, 100.0, 0.01)
+
+    # Windows with the same samples but a different FFT length are not duplicates
+    samples = WindowKeys(grid, grid['valid'])[:, :4]
+    assert len(np.unique(samples, axis=0)) < len(samples)
+
+
+def FittedSpectra(n, seed=0):
+    """
+    Spectra with random fits, some of which fail the checks of the Spectra Selection.
+    """
+    rng = np.random.default_rng(seed)
+    spectra = []
+    for k in range(1, n + 1):
+        fit = {'Omega0': 1e-6, 'Omega0Err': rng.uniform(1e-8, 1e-7), 'Fc': rng.uniform(0.2, 20), 'FcErr': rng.uniform(0.1, 2),
+               'Q': 200., 'QErr': rng.uniform(1, 50), 'DeltaOmega': rng.uniform(0, 1), 'Rms1': rng.uniform(1e-8, 1e-7),
+               'Rms2': rng.uniform(1, 80)}
+        spectra.append(Spectra(k, 'ST01', 10., 12., 2., 4., [9.5, 11.], [8., 9.5], np.arange(1., 30.), np.ones(29),
+                               np.arange(1., 30.), np.ones(29), rng.choice([40, 80]), fit, np.ones(29), None))
+    return spectra
+
+
+@pytest.mark.parametrize("cost_function", [True, False])
+@pytest.mark.parametrize("top_k", [1, 5, 20])
+def test_streaming_keeps_the_best_spectra(cfg, monkeypatch, cost_function, top_k):
+    cfg["SpectraSelection"]["CostFunctionClass"] = cost_function
+    cfg["WaveformProcessing"]["TopK"] = top_k
+    spectra = FittedSpectra(200)
+    windows = [(a.id, 0.5, 1.) for a in spectra]
+
+    def stream(cfg, windows, *args):
+        for k, a in enumerate(spectra):
+            assert sum(len(b.SigSpectrum) > 0 for b in spectra[:k]) <= top_k
+            yield a
+
+    def compute(cfg, id, *args):
+        return FittedSpectra(200)[id - 1]
+
+    monkeypatch.setattr(waveform_processing, "IterFitWindows", stream)
+    monkeypatch.setattr(waveform_processing, "SpectraProcessing", compute)
+
+    df_sel, df_all = RankSpectra(spectra, cfg, 'P')
+    best = list(df_all.loc[df_all['RMS_Normalized'] <= cfg["SpectraSelection"]["RmsNormThr"], 'No.'][:top_k])
+    assert len(best) == top_k
+
+    SpectraList = StreamWindows(cfg, windows, None, 'ST01', 'P')
+    assert sum(len(a.SigSpectrum) > 0 for a in SpectraList) <= top_k
+
+    fits = [a.CurveFit for a in SpectraList]
+    KeepBestSpectra(cfg, SpectraList, windows, None, 'ST01', 'P')
+    kept = [a for a in SpectraList if len(a.SigSpectrum)]
+    assert sorted(a.id for a in kept) == sorted(set(best) | set(df_sel['No.']))
+    assert [a.id for a in SpectraList] == [a.id for a in spectra]
+    assert [a.CurveFit for a in SpectraList] == fits
+    for a in kept:
+        assert len(a.SigSpectrum) == len(a.SigFrequencies) == len(a.CalculatedSpectrum) > 0
+
+
+def test_trim_keeps_the_picks_and_the_sac_times(cfg, stream, tmp_path):
+    original = stream.copy()
+    P, S = stream[0].stats.sac.a, stream[0].stats.sac.t0
+
+    TrimStation(cfg, stream)
+
+    for tr, ref in zip(stream, original):
+        shift = tr.stats.starttime - ref.stats.starttime
+        assert 0 < tr.stats.npts < ref.stats.npts
+        assert shift == pytest.approx(round(shift))
+        assert tr.stats.sac.a == pytest.approx(P - shift)
+        assert tr.stats.sac.t0 == pytest.approx(S - shift)
+        assert tr.stats.sac.b == ref.stats.sac.b
+
+        # The samples at the picks are unchanged
+        for old, new in [(P, tr.stats.sac.a), (S, tr.stats.sac.t0)]:
+            assert tr.data[int(round(new * tr.stats.sampling_rate))] == ref.data[int(round(old * ref.stats.sampling_rate))]
+
+        # Written and read back, the trace starts and is picked at the same absolute times
+        tr.write(str(tmp_path / "trimmed.SAC"), format="SAC")
+        back = read(str(tmp_path / "trimmed.SAC"))[0]
+        assert abs(back.stats.starttime - tr.stats.starttime) < 1e-3
+        assert abs((back.stats.starttime - back.stats.sac.b + back.stats.sac.a) - (ref.stats.starttime - ref.stats.sac.b + P)) < 1e-3